@@ -6,6 +6,8 @@ Returns a minimal output-like dict for a single scene, which we then merge into
 
 Public:
 - analyze_single_scene(scene_input, ...model params...) -> output-like dict for one scene
+- analyze_scenes([scene_input, ...], ...model params...) -> list of such dicts; scenes share the model
+  and are sent to the LLM in batches (one Stage 1 + one Stage 2 call per batch)
 
 scene_input format (required/optional):
 {
@@ -16,19 +18,30 @@ scene_input format (required/optional):
 """
 
 from __future__ import annotations
-import time, json, os, re
-from typing import Any, Dict, List, Optional
+import time, json, os, re, threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 # LLM backend
 from llama_cpp import Llama
+try:
+    from llama_cpp import LlamaRAMCache
+except ImportError:
+    LlamaRAMCache = None
 
 # Import constants and parser from the model package
 from ..model.constants import (
     LABELS, THEMATIC_GROUPS, SEVERITY_WEIGHT, SEV_MAP_INT2STR, SEV_MAP_STR2INT,
     FW_RULES, S1_EXCLUSIVE_PAIRS,
-    _PROFANITY_ROOT_PATTERNS, _ALIAS_MAP
+    _PROFANITY_ALT, _ALIAS_MAP
 )
-from ..model.parser_llm import parse_llm_response
+from ..model.parser_llm import has_complete_final_json, parse_llm_response
+
+try:
+    import orjson
+except ImportError:
+    orjson=None
 
 # -------- Harmony (optional) --------
 try:
@@ -49,14 +62,78 @@ except Exception:
     ReasoningEffort=Dummy
 
 
+# -------- JSON --------
+# orjson encodes straight to compact UTF-8; the stdlib fallback is given the same separators so the
+# prompt text does not depend on which one is installed
+def _json_str(obj: Any)->str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj,ensure_ascii=False,separators=(",",":"))
+
+
+# -------- Model / encoding cache --------
+# Loading the GGUF and allocating the KV cache takes tens of seconds, so one model per parameter set
+# lives for the whole process. A llama.cpp context is not thread-safe: each model is stored with its
+# own lock and concurrent callers generate one at a time.
+_LLM_CACHE: Dict[tuple, Tuple[Llama, threading.Lock]] = {}
+_LLM_LOCK = threading.Lock()
+_ENCODING_CACHE: Dict[str, Any] = {}
+_PIPELINE_WORKERS = 2  # batches in flight in analyze_scenes: one generating, one being post-processed
+
+def _attach_kv_cache(llm: Llama, kv_cache_mb: int)->None:
+    # Saved KV states of recent prompts: the next batch restores the longest matching prefix (the
+    # instruction block of its stage) instead of prefilling it again after the other stage's prompt
+    if kv_cache_mb>0 and LlamaRAMCache is not None and getattr(llm,"cache",None) is None:
+        llm.set_cache(LlamaRAMCache(capacity_bytes=kv_cache_mb<<20))
+
+def _get_llm(model_path: Optional[str], repo_id: str, filename: str, n_ctx: int, n_gpu_layers: int,
+             kv_cache_mb: int = 0)->Tuple[Llama, threading.Lock]:
+    key=(model_path or (repo_id, filename), n_ctx, n_gpu_layers)
+    with _LLM_LOCK:
+        entry=_LLM_CACHE.get(key)
+        if entry is not None:
+            return entry
+        if model_path:
+            llm = Llama(model_path=model_path, n_ctx=n_ctx, n_gpu_layers=n_gpu_layers, verbose=False)
+        elif hasattr(Llama,"from_pretrained"):
+            llm = Llama.from_pretrained(repo_id=repo_id, filename=filename,
+                                        n_ctx=n_ctx, n_gpu_layers=n_gpu_layers, verbose=False)
+        else:
+            llm = Llama(model_path=filename, n_ctx=n_ctx, n_gpu_layers=n_gpu_layers, verbose=False)
+        _attach_kv_cache(llm, kv_cache_mb)
+        entry=(llm, threading.Lock())
+        _LLM_CACHE[key]=entry
+        return entry
+
+def _get_encoding():
+    if not HARMONY_AVAILABLE:
+        return None
+    with _LLM_LOCK:
+        if "gpt_oss" not in _ENCODING_CACHE:
+            _ENCODING_CACHE["gpt_oss"]=load_harmony_encoding(HarmonyEncodingName.HARMONY_GPT_OSS)
+        return _ENCODING_CACHE["gpt_oss"]
+
+
+_RE_SEP = re.compile(r"[\s\-/]+")
+_RE_STRIP = re.compile(r"[^a-z0-9_]+")
+_LABELS_SET = frozenset(LABELS)
+_PLAIN_CHARS = frozenset("abcdefghijklmnopqrstuvwxyz0123456789_")
+
 def normalize_label(raw: Any)->Optional[str]:
     if not isinstance(raw,str): return None
+    return _normalize_label_str(raw)
+
+# labels repeat across sentences, so string normalization is memoized
+@lru_cache(maxsize=4096)
+def _normalize_label_str(raw: str)->Optional[str]:
     s=raw.strip().lower()
-    s=re.sub(r"[\s\-/]+","_",s)
-    s=re.sub(r"[^a-z0-9_]+","",s)
+    # labels usually come back already in snake_case: then both substitutions are no-ops
+    if not _PLAIN_CHARS.issuperset(s):
+        s=_RE_SEP.sub("_",s)
+        s=_RE_STRIP.sub("",s)
     if s in _ALIAS_MAP: return _ALIAS_MAP[s]
     up=s.upper()
-    if up in LABELS: return up
+    if up in _LABELS_SET: return up
     if s.startswith("weapon") and "usage" in s: return "WEAPONS_USAGE"
     if s.startswith("weapon") and any(k in s for k in ("mention","shown","present")): return "WEAPONS_MENTION"
     return None
@@ -72,58 +149,78 @@ def _effort_temperature(effort: str)->float:
     return 0.15 if e=="high" else (0.08 if e=="medium" else 0.01)
 
 
-def build_stage1_conversation(batch: List[Dict], encoding, llm_effort: str="low")->tuple[str,List[str]]:
+@lru_cache(maxsize=None)
+def _system_message(effort: str):
+    sysc=SystemContent.new().with_reasoning_effort(_effort_to_reasoning(effort)).with_required_channels(["final"])
+    return Message.from_role_and_content(Role.SYSTEM, sysc)
+
+# A plain string without Harmony, otherwise the rendered token ids: create_completion accepts both, so
+# the prompt is neither decoded back to text nor tokenized again
+Prompt=Union[str,List[int]]
+
+def _render_prompt(user_content: str, encoding, llm_effort: str)->Prompt:
+    # Stage 1 and Stage 2 use the same system message for the same effort, so both prompts start with
+    # an identical token prefix that llama.cpp (and the RAM cache, see _get_llm) does not prefill again
+    if HARMONY_AVAILABLE and encoding:
+        convo=Conversation.from_messages([
+            _system_message((llm_effort or "low").lower()),
+            Message.from_role_and_content(Role.USER, user_content)
+        ])
+        return list(encoding.render_conversation_for_completion(convo, Role.ASSISTANT))
+    return user_content
+
+
+_STAGE1_INSTRUCTION=(
+    "You analyze Russian screenplay sentences. Return ONLY JSON:\n"
+    "{\"scene_results\":[{\"scID\":int,\"snt\":[{\"id\":int,\"vlc\":[{\"label\":string,\"conf\":int}]}]}]}\n"
+    "MANDATORY: Each scene MUST have at least ONE sentence with at least ONE label. If all are neutral, assign MILD_CONFLICT to the most contextually active sentence.\n"
+    "Gates:\n"
+    "- VIOLENCE_GRAPHIC: explicit gore/blood/wounds/torture only.\n"
+    "- MURDER_HOMICIDE: clear attempt or commission.\n"
+    "- DRUGS_USE_DEPICTION: explicit HUMAN illegal/controlled drug consumption or explicit name of such drug.\n"
+    "- PROFANITY_OBSCENE: only if sentence contains obscene root (-бзд-;-бля-;-(ё/е)б-;-елд-;-говн-;-жоп-;-манд-;-муд-;-перд-;-пизд-;-сра-;-(с)са-;-хуе-/-хуй-/-хуя-;-шлюх-).\n"
+    "Confidence 0..100. Do NOT include original texts back. final-only."
+)
+_LABELS_JSON=_json_str(LABELS)
+# the constant part of the prompt is built once at import
+_STAGE1_PREFIX="".join((_STAGE1_INSTRUCTION, "\nAllowed labels:", _LABELS_JSON, "\nInput:"))
+
+
+def build_stage1_conversation(batch: List[Dict], encoding, llm_effort: str="low")->tuple[Prompt,List[str]]:
     payload=[]
     for s in batch:
         sc_id=s["scene_index"]
         sents=[{"id":i,"t":sent.get("text","")} for i,sent in enumerate(s.get("sentences",[]))]
         payload.append({"scID":sc_id,"snt":sents})
-    instruction=(
-        "You analyze Russian screenplay sentences. Return ONLY JSON:\n"
-        "{\"scene_results\":[{\"scID\":int,\"snt\":[{\"id\":int,\"vlc\":[{\"label\":string,\"conf\":int}]}]}]}\n"
-        "MANDATORY: Each scene MUST have at least ONE sentence with at least ONE label. If all are neutral, assign MILD_CONFLICT to the most contextually active sentence.\n"
-        "Gates:\n"
-        "- VIOLENCE_GRAPHIC: explicit gore/blood/wounds/torture only.\n"
-        "- MURDER_HOMICIDE: clear attempt or commission.\n"
-        "- DRUGS_USE_DEPICTION: explicit HUMAN illegal/controlled drug consumption or explicit name of such drug.\n"
-        "- PROFANITY_OBSCENE: only if sentence contains obscene root (-бзд-;-бля-;-(ё/е)б-;-елд-;-говн-;-жоп-;-манд-;-муд-;-перд-;-пизд-;-сра-;-(с)са-;-хуе-/-хуй-/-хуя-;-шлюх-).\n"
-        "Confidence 0..100. Do NOT include original texts back. final-only."
-    )
-    user_content=instruction+"\nAllowed labels:"+json.dumps(LABELS,ensure_ascii=False)+"\nInput:"+json.dumps(payload,ensure_ascii=False)
-    if HARMONY_AVAILABLE and encoding:
-        sysc=SystemContent.new().with_reasoning_effort(_effort_to_reasoning(llm_effort)).with_required_channels(["final"])
-        convo=Conversation.from_messages([
-            Message.from_role_and_content(Role.SYSTEM, sysc),
-            Message.from_role_and_content(Role.USER, user_content)
-        ])
-        tokens=encoding.render_conversation_for_completion(convo, Role.ASSISTANT)
-        return encoding.decode(tokens), []
-    return user_content, []
-
-
-def build_stage2_conversation(q_batch: List[Dict], encoding, llm_effort: str="low")->tuple[str,List[str]]:
-    instruction=(
-        "You rate Russian screenplay sentences. Return ONLY JSON:\n"
-        "{\"ans\":[{\"scID\":int,\"id\":int,\"det\":[{\"label\":string,\"sev\":\"Mild|Moderate|Severe\",\"scr\":int,\"rsn\":string,\"adv\":string,\"ok\":boolean,\"suggest\":string|null}]}]}\n"
-        "FOR EACH input label produce a det object. Use allowed labels exactly. Profanity only if obscene roots.\n"
-        "Drugs depiction only explicit illegal human use; else ok=false suggest DRUGS_MENTION_NON_DETAILED/REMOVE.\n"
-        "sev from th; scr from bs (+/- brief rationale). final-only."
-    )
-    user_payload={"fw":FW_RULES,"Queries":q_batch}
-    user_content=instruction+"\n"+json.dumps(user_payload,ensure_ascii=False)
-    if HARMONY_AVAILABLE and encoding:
-        sysc=SystemContent.new().with_reasoning_effort(_effort_to_reasoning(llm_effort)).with_required_channels(["final"])
-        convo=Conversation.from_messages([
-            Message.from_role_and_content(Role.SYSTEM, sysc),
-            Message.from_role_and_content(Role.USER, user_content)
-        ])
-        tokens=encoding.render_conversation_for_completion(convo, Role.ASSISTANT)
-        return encoding.decode(tokens), []
-    return user_content, []
+    user_content="".join((_STAGE1_PREFIX, _json_str(payload)))
+    return _render_prompt(user_content, encoding, llm_effort), []
+
+
+_STAGE2_INSTRUCTION=(
+    "You rate Russian screenplay sentences. Return ONLY JSON:\n"
+    "{\"ans\":[{\"scID\":int,\"id\":int,\"det\":[{\"label\":string,\"sev\":\"Mild|Moderate|Severe\",\"scr\":int,\"rsn\":string,\"adv\":string,\"ok\":boolean,\"suggest\":string|null}]}]}\n"
+    "FOR EACH input label produce a det object. Use allowed labels exactly. Profanity only if obscene roots.\n"
+    "Drugs depiction only explicit illegal human use; else ok=false suggest DRUGS_MENTION_NON_DETAILED/REMOVE.\n"
+    "sev from th; scr from bs (+/- brief rationale). final-only."
+)
+_FW_RULES_JSON=_json_str(FW_RULES)
+# {"fw":FW_RULES,"Queries":[...]}: FW_RULES is the first key and never changes, so it is serialized once
+_STAGE2_PREFIX="".join((_STAGE2_INSTRUCTION, "\n{\"fw\": ", _FW_RULES_JSON, ", \"Queries\": "))
+
 
+def build_stage2_conversation(q_batch: List[Dict], encoding, llm_effort: str="low")->tuple[Prompt,List[str]]:
+    user_content="".join((_STAGE2_PREFIX, _json_str(q_batch), "}"))
+    return _render_prompt(user_content, encoding, llm_effort), []
+
+
+# labels are a fixed small set: per-sentence bookkeeping uses a list indexed by label id, not a dict
+_LABEL2IDX={lab:i for i,lab in enumerate(LABELS)}
+_S1_EXCLUSIVE_IDX=tuple((_LABEL2IDX[a],_LABEL2IDX[b]) for a,b in S1_EXCLUSIVE_PAIRS)
 
 def _collect_stage1_labels(vlc_list: List[Any], sentence_text: str)->List[Dict[str,Any]]:
-    best={}
+    best=[None]*len(LABELS)
+    order=[]  # label ids in order of first appearance (the output keeps that order)
+    obscene=None  # root check runs once per sentence and only if the model proposed PROFANITY_OBSCENE
     for v in (vlc_list or []):
         if isinstance(v,str):
             lab_raw=v; conf=None
@@ -135,52 +232,78 @@ def _collect_stage1_labels(vlc_list: List[Any], sentence_text: str)->List[Dict[s
         lab=normalize_label(lab_raw)
         if not lab: continue
         if lab=="PROFANITY_OBSCENE":
-            t=sentence_text.lower().replace("ё","е")
-            if not any(p.search(t) for p in _PROFANITY_ROOT_PATTERNS):
+            if obscene is None:
+                obscene=_PROFANITY_ALT.search(sentence_text.lower().replace("ё","е")) is not None
+            if not obscene:
                 continue
         c=int(conf) if isinstance(conf,(int,float)) else 0
-        if lab not in best or c>best[lab]:
-            best[lab]=c
-    for a,b in S1_EXCLUSIVE_PAIRS:
-        if a in best and b in best:
-            if best[a]>=best[b]: del best[b]
-            else: del best[a]
-    return [{"label":lab,"conf":best[lab]} for lab in best]
-
-
-def _severity_from_base_score(base: int)->str:
+        i=_LABEL2IDX[lab]
+        prev=best[i]
+        if prev is None:
+            best[i]=c; order.append(i)
+        elif c>prev:
+            best[i]=c
+    if len(order)>1:
+        for a,b in _S1_EXCLUSIVE_IDX:
+            ca=best[a]; cb=best[b]
+            if ca is not None and cb is not None:
+                if ca>=cb: best[b]=None
+                else: best[a]=None
+    return [{"label":LABELS[i],"conf":best[i]} for i in order if best[i] is not None]
+
+
+def _severity_from_base_score_slow(base: int)->str:
     for name,(lo,hi) in FW_RULES["th"].items():
         if lo<=base<=hi: return name
     return "Severe" if base>=80 else ("Moderate" if base>=50 else ("Mild" if base>=25 else "None"))
 
+# base scores live in 0..100, so FW_RULES["th"] is expanded into a lookup table once
+_BASE_SEV_TABLE=[_severity_from_base_score_slow(i) for i in range(101)]
+
+def _severity_from_base_score(base: int)->str:
+    return _BASE_SEV_TABLE[base] if 0<=base<=100 else _severity_from_base_score_slow(base)
+
+# default base score / severity per label (labels reaching these lookups are already normalized)
+_BASE_BY_LABEL: Dict[str,int]={lab: int(FW_RULES["bs"].get(lab,40)) for lab in LABELS}
+_DEFAULT_SEV_BY_LABEL: Dict[str,str]={lab: _severity_from_base_score(b) for lab,b in _BASE_BY_LABEL.items()}
+
+
+def _fill_evidence_defaults(ev: Dict[str,Dict[str,Any]])->None:
+    for lab, span in ev.items():
+        if not span.get("severity"):
+            span["severity"]=_DEFAULT_SEV_BY_LABEL.get(lab) or _severity_from_base_score(int(FW_RULES["bs"].get(lab,40)))
+        if not span.get("reason"):
+            span["reason"]="Авто: требуется сверка с текстом."
+        if not span.get("advice"):
+            span["advice"]="Смягчить при необходимости."
+
 
 def finalize_evidence_fields(problem_fragments: List[Dict])->None:
     for pf in problem_fragments:
         ev=pf.get("evidence_spans",{})
-        for lab, span in ev.items():
-            if not span.get("severity"):
-                base=FW_RULES["bs"].get(lab,40)
-                span["severity"]=_severity_from_base_score(int(base))
-            if not span.get("reason"):
-                span["reason"]="Авто: требуется сверка с текстом."
-            if not span.get("advice"):
-                span["advice"]="Смягчить при необходимости."
+        _fill_evidence_defaults(ev)
         pf["severity_local"]=_compute_severity_local_from_evidence(ev)
 
 
+# severities are written in canonical case ("Mild"), so most lookups hit without str()/lower()
+_SEV_INT: Dict[str,int]={**SEV_MAP_STR2INT, **{k.capitalize(): v for k,v in SEV_MAP_STR2INT.items()}}
+
+def _sev_int(sev: Any)->int:
+    v=_SEV_INT.get(sev) if isinstance(sev,str) else None
+    return v if v is not None else SEV_MAP_STR2INT.get(str(sev).lower(),0)
+
+
 def _compute_severity_local_from_evidence(ev: Dict[str,Dict[str,Any]])->str:
-    max_v=0
-    for data in ev.values():
-        sev=str(data.get("severity","")).lower()
-        max_v=max(max_v, SEV_MAP_STR2INT.get(sev,0))
+    max_v=max((_sev_int(data.get("severity","")) for data in ev.values()), default=0)
     return SEV_MAP_INT2STR.get(max_v,"None")
 
 
 def build_problem_fragments_from_compact(compact_items: List[Dict], all_scenes: List[Dict])->List[Dict]:
     frags=[]
+    heading_by_id={s["scene_index"]: s.get("heading","") for s in all_scenes}
     for scene in compact_items:
         sc_id=scene["scene_index"]
-        heading=next((s.get("heading","") for s in all_scenes if s["scene_index"]==sc_id),"")
+        heading=heading_by_id.get(sc_id,"")
         for s_item in scene.get("sentences",[]):
             viols=s_item.get("violations",[])
             labels=[v.get("label") for v in viols if v.get("label")]
@@ -207,13 +330,15 @@ def build_problem_fragments_from_compact(compact_items: List[Dict], all_scenes:
 
 
 def ensure_stage2_backfill(q_batch: List[Dict], parsed2: Optional[Dict])->List[Dict]:
+    norm_cache: Dict[str,Optional[str]]={}
     def _norm_label(x: Any)->Optional[str]:
-        if isinstance(x,str):
-            return normalize_label(x)
         if isinstance(x,dict):
-            v=x.get("label")
-            return normalize_label(v) if isinstance(v,str) else None
-        return None
+            x=x.get("label")
+        if not isinstance(x,str):
+            return None
+        if x not in norm_cache:
+            norm_cache[x]=normalize_label(x)
+        return norm_cache[x]
 
     model_map={}
     if isinstance(parsed2,dict) and isinstance(parsed2.get("ans"),list):
@@ -247,15 +372,14 @@ def ensure_stage2_backfill(q_batch: List[Dict], parsed2: Optional[Dict])->List[D
             lab=_norm_label(v)
             if lab: in_labels.append(lab)
         # preserve order unique
-        seen=set(); in_labels=[x for x in in_labels if not (x in seen or seen.add(x))]
+        in_labels=list(dict.fromkeys(in_labels))
         det_out=[]
         mlabs=model_map.get((scid,sid),{})
         for lab in in_labels:
-            base=int(FW_RULES["bs"].get(lab,40))
             default={
                 "label": lab,
-                "sev": _severity_from_base_score(base),
-                "scr": base,
+                "sev": _DEFAULT_SEV_BY_LABEL[lab],
+                "scr": _BASE_BY_LABEL[lab],
                 "rsn": "Авто: базовая оценка.",
                 "adv": "Редактура: смягчить при необходимости.",
                 "ok": True,
@@ -269,11 +393,10 @@ def ensure_stage2_backfill(q_batch: List[Dict], parsed2: Optional[Dict])->List[D
         # model-added labels
         for lab, md in mlabs.items():
             if lab not in in_labels:
-                base=int(FW_RULES["bs"].get(lab,40))
                 det_out.append({
                     "label": lab,
-                    "sev": md.get("sev", _severity_from_base_score(base)),
-                    "scr": md.get("scr", base),
+                    "sev": md.get("sev", _DEFAULT_SEV_BY_LABEL[lab]),
+                    "scr": md.get("scr", _BASE_BY_LABEL[lab]),
                     "rsn": md.get("rsn","Авто: добавлено моделью."),
                     "adv": md.get("adv","Редактура: смягчить при необходимости."),
                     "ok": md.get("ok",True),
@@ -283,46 +406,69 @@ def ensure_stage2_backfill(q_batch: List[Dict], parsed2: Optional[Dict])->List[D
     return full
 
 
-def apply_stage2(full_ans: List[Dict], problem_fragments: List[Dict])->List[Dict]:
-    det_map={(a.get("scID"), a.get("id")): a.get("det",[]) for a in full_ans}
+def apply_stage2(full_ans: List[Dict], problem_fragments: List[Dict], finalize: bool=False)->List[Dict]:
+    """
+    Applies Stage 2 details to fragments. With finalize=True, touched fragments also get evidence
+    defaults in the same pass, which replaces a separate finalize_evidence_fields() over all
+    fragments. Untouched fragments are expected to be finalized already (after Stage 1).
+    """
+    # labels are normalized once while indexing, not per fragment
+    _norm=normalize_label
+    det_map={(a.get("scID"), a.get("id")): [(lab, d) for d in a.get("det",[]) if (lab:=_norm(d.get("label")))]
+             for a in full_ans}
     out=[]
     for pf in problem_fragments:
-        key=(pf["scene_index"], pf["sentence_index"])
-        if key not in det_map:
+        dets=det_map.get((pf["scene_index"], pf["sentence_index"]))
+        if dets is None:
             out.append(pf); continue
         ev=pf.get("evidence_spans",{})
-        labels=list(pf.get("labels") or [])
+        labels=dict.fromkeys(pf.get("labels") or [])  # ordered set: O(1) add/remove
         adv_acc=[]
-        for d in det_map[key]:
-            lab=normalize_label(d.get("label"))
-            if not lab: continue
+        for lab, d in dets:
             if d.get("ok") is False and (d.get("suggest") in ("REMOVE","remove")):
-                if lab in labels: labels=[x for x in labels if x!=lab]
-                if lab in ev: ev.pop(lab,None)
+                labels.pop(lab,None)
+                ev.pop(lab,None)
                 continue
             if lab not in labels:
-                labels.append(lab)
+                labels[lab]=None
                 ev[lab]={"severity":"", "score":None, "reason":"", "advice":None, "trigger":None}
-            if lab in ev:
-                if d.get("sev"): ev[lab]["severity"]=d["sev"]
-                if isinstance(d.get("scr"),(int,float)): ev[lab]["score"]=int(d["scr"])
-                if isinstance(d.get("rsn"),str) and d["rsn"].strip(): ev[lab]["reason"]=d["rsn"].strip()
-                if isinstance(d.get("adv"),str) and d["adv"].strip():
-                    ev[lab]["advice"]=d["adv"].strip(); adv_acc.append(d["adv"].strip())
+            span=ev.get(lab)
+            if span is not None:
+                sev=d.get("sev"); scr=d.get("scr"); rsn=d.get("rsn"); adv=d.get("adv")
+                if sev: span["severity"]=sev
+                if isinstance(scr,(int,float)): span["score"]=int(scr)
+                if isinstance(rsn,str) and rsn.strip(): span["reason"]=rsn.strip()
+                if isinstance(adv,str) and adv.strip():
+                    span["advice"]=adv.strip(); adv_acc.append(span["advice"])
         if labels and ev:
-            pf["labels"]=labels
+            if finalize: _fill_evidence_defaults(ev)
+            pf["labels"]=list(labels)
             pf["evidence_spans"]=ev
+            # recomputed over ev rather than tracked inline: a REMOVE can lower the maximum
             pf["severity_local"]=_compute_severity_local_from_evidence(ev)
             if adv_acc: pf["recommendations"]=list(dict.fromkeys(adv_acc))
             out.append(pf)
     return out
 
 
+_GROUP_LABEL_SETS: Dict[str,frozenset]={g: frozenset(labs) for g,labs in THEMATIC_GROUPS.items()}
+_LABEL_GROUPS: Dict[str,Tuple[str,...]]={l: tuple(g for g,labs in _GROUP_LABEL_SETS.items() if l in labs) for l in LABELS}
+
 def aggregate_parents_guide(problem_fragments: List[Dict]) -> Dict[str,Any]:
     total_scenes=1
+    # one pass over fragments: each fragment is routed to the groups of its labels (once per group)
+    eps_by_group: Dict[str,List[Dict]]={}
+    for pf in problem_fragments:
+        for l in pf["labels"]:
+            for g in _LABEL_GROUPS.get(l,()):
+                lst=eps_by_group.get(g)
+                if lst is None:
+                    eps_by_group[g]=[pf]
+                elif lst[-1] is not pf:
+                    lst.append(pf)
     guide={}
-    for group,labs in THEMATIC_GROUPS.items():
-        eps=[pf for pf in problem_fragments if any(l in labs for l in pf["labels"])]
+    for group,labs in _GROUP_LABEL_SETS.items():
+        eps=eps_by_group.get(group)
         if not eps:
             guide[group]={"severity":"None","episodes":0,"scenes_with_issues_percent":0.0,"examples":[]}
             continue
@@ -349,23 +495,83 @@ def aggregate_parents_guide(problem_fragments: List[Dict]) -> Dict[str,Any]:
     return guide
 
 
+def _stream_completion(llm: Llama, gen: Dict[str,Any], stop_key: str)->str:
+    # chunks go into a list (no quadratic concatenation); completeness is only checked on a closing
+    # bracket, and generation stops as soon as the final channel holds a closed object with stop_key
+    parts=[]
+    stream=llm.create_completion(**gen, stream=True)
+    try:
+        for chunk in stream:
+            piece=chunk["choices"][0].get("text","")
+            parts.append(piece)
+            if piece.rstrip().endswith(("}","]")) and has_complete_final_json("".join(parts), stop_key):
+                break
+    finally:
+        if hasattr(stream,"close"): stream.close()
+    return "".join(parts)
+
+
+_RETRY_SEED_STEP = 7919
+# at the near-greedy sampling of low effort a new seed alone rarely changes the text
+_RETRY_TEMPERATURE_STEP = 0.1
+
+# Output budgets grow with the payload instead of a flat per-scene cap (the base covers the analysis
+# channel and the JSON envelope), and never exceed what is left of the context after the prompt.
+_S1_OUT_TOKENS_BASE = 512
+_S1_OUT_TOKENS_PER_SENTENCE = 48
+_S2_OUT_TOKENS_BASE = 512
+_S2_OUT_TOKENS_PER_QUERY = 192
+_CTX_MARGIN = 256
+
+def _max_tokens(llm: Llama, prompt: Prompt, n_ctx: int, want: int)->int:
+    # called with llm_lock held: the plain-text fallback (no Harmony) tokenizes with the shared model
+    n_prompt=len(prompt) if isinstance(prompt, list) else len(llm.tokenize(prompt.encode("utf-8"), special=True))
+    return max(1, min(want, n_ctx-n_prompt-_CTX_MARGIN))
+
+def _generate_with_retry(llm: Llama, llm_lock: threading.Lock, gen: Dict[str,Any], retries: int,
+                         encoding, effort: str, debug_dir: Optional[str], prefer: str,
+                         n_ctx: int, want_tokens: int)->Dict:
+    """
+    Generates and parses one response; max_tokens is want_tokens capped by what the prompt leaves of
+    n_ctx. Every use of the model happens here under llm_lock. An unparseable answer is retried at once
+    with another seed and a higher temperature (the same sampler reproduces the same text); a backend
+    error is retried after a short exponential backoff. The last failure is re-raised.
+    """
+    gen=dict(gen)
+    attempts=max(1,retries)
+    for attempt in range(attempts):
+        last=attempt+1==attempts
+        try:
+            with llm_lock:
+                if "max_tokens" not in gen:
+                    gen["max_tokens"]=_max_tokens(llm, gen["prompt"], n_ctx, want_tokens)
+                raw=_stream_completion(llm, gen, prefer)
+        except Exception:
+            if last: raise
+            time.sleep(0.05*2**attempt)
+            continue
+        try:
+            return parse_llm_response(raw, encoding, effort=effort, debug_dir=debug_dir, prefer=prefer)
+        except Exception:
+            if last: raise
+            gen["seed"]=gen.get("seed",0)+_RETRY_SEED_STEP
+            gen["temperature"]=gen.get("temperature",0)+_RETRY_TEMPERATURE_STEP
+
+
+_RATING_BY_SEV = {1:"12+", 2:"16+", 3:"18+"}
+
 def _infer_final_rating(parents_guide: Dict[str,Any])->str:
-    max_sev=0
-    for g in parents_guide.values():
-        sev=SEV_MAP_STR2INT.get(str(g.get("severity","")).lower(),0)
-        max_sev=max(max_sev, sev)
-    if max_sev>=3: return "18+"
-    if max_sev==2: return "16+"
-    if max_sev==1: return "12+"
+    max_sev=max((_sev_int(g.get("severity","")) for g in parents_guide.values()), default=0)
+    if max_sev: return _RATING_BY_SEV[max_sev]
     if any(g.get("episodes",0)>0 for g in parents_guide.values()):
         return "6+"
     return "0+"
 
 
-def analyze_single_scene(
-    scene_input: Dict[str, Any],
+def analyze_scenes(
+    scene_inputs: List[Dict[str, Any]],
     *,
-    document_name: str = "single_scene",
+    document_name: str = "scenes",
     repo_id: str = "unsloth/gpt-oss-20b-GGUF",
     filename: str = "gpt-oss-20b-F16.gguf",
     model_path: Optional[str] = None,
@@ -376,141 +582,177 @@ def analyze_single_scene(
     retries: int = 3,
     debug_dir: Optional[str] = None,
     seed_stage1: int = 101,
-    seed_stage2: int = 202
-) -> Dict[str, Any]:
+    seed_stage2: int = 202,
+    batch_size: int = 4,
+    kv_cache_mb: int = 0
+) -> List[Dict[str, Any]]:
+    """
+    Stage 1 + Stage 2 for several scenes with one model load.
+    Scenes are grouped by batch_size: one Stage 1 prompt per group (scID = position in scene_inputs),
+    then one Stage 2 prompt with all queries of that group. Returns one report per input scene, in order.
+    """
     start=time.time()
+    batch_size=max(1,batch_size)
 
     # Validate input
-    sentences = scene_input.get("sentences", [])
-    if not isinstance(sentences, list) or not all(isinstance(x,str) for x in sentences):
-        raise ValueError("scene_input['sentences'] must be a list of strings.")
-    scene = {
-        "scene_index": 0,
-        "heading": scene_input.get("heading",""),
-        "page": scene_input.get("page"),
-        "sentences": [{"text": s} for s in sentences]
-    }
-    scenes = [scene]
-
-    # Harmony encoding (optional)
-    encoding = load_harmony_encoding(HarmonyEncodingName.HARMONY_GPT_OSS) if HARMONY_AVAILABLE else None
-
-    # Initialize LLM
-    if model_path:
-        llm = Llama(model_path=model_path, n_ctx=n_ctx, n_gpu_layers=n_gpu_layers, verbose=False)
+    scenes=[]
+    scene_texts: List[List[str]]=[]  # sentence texts by scene_index, for packing and Stage 2 context
+    for i,scene_input in enumerate(scene_inputs):
+        sentences = scene_input.get("sentences", [])
+        if not isinstance(sentences, list) or not all(isinstance(x,str) for x in sentences):
+            raise ValueError("scene_input['sentences'] must be a list of strings.")
+        scenes.append({
+            "scene_index": i,
+            "heading": scene_input.get("heading",""),
+            "page": scene_input.get("page"),
+            "sentences": [{"text": s} for s in sentences]
+        })
+        scene_texts.append(sentences)
+
+    # Harmony encoding (optional) and LLM are cached per process
+    encoding = _get_encoding()
+    llm, llm_lock = _get_llm(model_path, repo_id, filename, n_ctx, n_gpu_layers, kv_cache_mb)
+
+    def _run_batch(b: int)->List[Dict]:
+        batch = scenes[b:b+batch_size]
+        batch_by_id = {sc["scene_index"]: sc for sc in batch}
+
+        # ---------- Stage 1 ----------
+        prompt_s1,_ = build_stage1_conversation(batch, encoding, llm_effort_s1)
+        n_sent = sum(len(sc["sentences"]) for sc in batch)
+        out_s1 = min(2048*len(batch), _S1_OUT_TOKENS_BASE+_S1_OUT_TOKENS_PER_SENTENCE*n_sent)
+        gen1 = {
+            "prompt": prompt_s1,
+            "temperature": _effort_temperature(llm_effort_s1),
+            "top_p": 0.3,
+            "repeat_penalty": 1.05,
+            "seed": seed_stage1+b
+        }
+        parsed_s1 = _generate_with_retry(llm, llm_lock, gen1, retries, encoding, llm_effort_s1,
+                                         debug_dir, "scene_results", n_ctx, out_s1)
+
+        # Convert scene_results -> problem_fragments
+        converted=[]
+        scene_results=[]
+        if isinstance(parsed_s1,dict) and isinstance(parsed_s1.get("scene_results"),list):
+            scene_results = parsed_s1["scene_results"]
+        elif isinstance(parsed_s1,list):
+            scene_results = parsed_s1
+
+        for sr in scene_results:
+            if not isinstance(sr,dict): continue
+            sc_id=sr.get("scID")
+            if not (isinstance(sc_id,int) and sc_id in batch_by_id): continue
+            texts=scene_texts[sc_id]; n_texts=len(texts)
+            snts=sr.get("snt",[])
+            packed=[]  # (id, text, violations); dicts are built once the scene is complete
+            for item in snts:
+                if not isinstance(item,dict): continue
+                sid=item.get("id")
+                if sid is None: continue
+                vlc=item.get("vlc",[])
+                text_val=texts[sid] if sid < n_texts else ""
+                norm=_collect_stage1_labels(vlc, text_val)
+                if norm or vlc==[]:
+                    packed.append((sid,text_val,norm))
+            if not packed: continue
+            if not any(p[2] for p in packed):
+                packed[0]=(packed[0][0],packed[0][1],[{"label":"MILD_CONFLICT","conf":60}])
+            converted.append({"scene_index":sc_id,
+                              "sentences":[{"id":sid,"text":t,"violations":v} for sid,t,v in packed]})
+
+        problem_fragments = build_problem_fragments_from_compact(converted, batch)
+
+        # Defaults in evidence + severity_local
+        finalize_evidence_fields(problem_fragments)
+        if not problem_fragments:
+            return problem_fragments
+
+        # ---------- Stage 2 ----------
+        # Build queries with small context (prev, next)
+        queries=[]
+        for pf in problem_fragments:
+            scID=pf["scene_index"]; sid=pf["sentence_index"]
+            texts=scene_texts[scID]
+            pt=texts[sid-1] if sid>0 else ""
+            nt=texts[sid+1] if sid+1<len(texts) else ""
+            queries.append({"scID": scID, "id": sid, "pt": pt, "t": pf["text"], "nt": nt, "vlc": pf["labels"]})
+
+        prompt_s2,_ = build_stage2_conversation(queries, encoding, llm_effort_s2)
+        out_s2=min(4096*len(batch), _S2_OUT_TOKENS_BASE+_S2_OUT_TOKENS_PER_QUERY*len(queries))
+        gen2={
+            "prompt": prompt_s2,
+            "temperature": _effort_temperature(llm_effort_s2),
+            "top_p": 0.3,
+            "repeat_penalty": 1.05,
+            "seed": seed_stage2+b
+        }
+        parsed_s2=_generate_with_retry(llm, llm_lock, gen2, retries, encoding, llm_effort_s2,
+                                       debug_dir, "ans", n_ctx, out_s2)
+
+        ans_full=ensure_stage2_backfill(queries, parsed_s2)
+        return apply_stage2(ans_full, problem_fragments, finalize=True)
+
+    # Batches are independent (own prompts and seeds). Every model call (tokenize, completion) goes
+    # through _generate_with_retry under llm_lock; the workers only overlap prompt building and
+    # post-processing, which llama.cpp allows since it releases the GIL while decoding.
+    starts=list(range(0, len(scenes), batch_size))
+    if len(starts)>1:
+        with ThreadPoolExecutor(max_workers=_PIPELINE_WORKERS) as ex:
+            batch_frags=list(ex.map(_run_batch, starts))
     else:
-        if hasattr(Llama,"from_pretrained"):
-            llm = Llama.from_pretrained(repo_id=repo_id, filename=filename,
-                                        n_ctx=n_ctx, n_gpu_layers=n_gpu_layers, verbose=False)
-        else:
-            llm = Llama(model_path=filename, n_ctx=n_ctx, n_gpu_layers=n_gpu_layers, verbose=False)
+        batch_frags=[_run_batch(b) for b in starts]
 
-    problem_fragments: List[Dict] = []
-
-    # ---------- Stage 1 ----------
-    prompt_s1,_ = build_stage1_conversation(scenes, encoding, llm_effort_s1)
-    raw_s1=""; parsed_s1=None
-    gen1 = {
-        "prompt": prompt_s1,
-        "temperature": _effort_temperature(llm_effort_s1),
-        "max_tokens": 2048,
-        "top_p": 0.3,
-        "repeat_penalty": 1.05,
-        "seed": seed_stage1
-    }
-    for attempt in range(max(1,retries)):
-        try:
-            resp = llm.create_completion(**gen1)
-            raw_s1 = resp["choices"][0].get("text","")
-            parsed_s1 = parse_llm_response(raw_s1, encoding, effort=llm_effort_s1,
-                                           debug_dir=debug_dir, prefer="scene_results")
-            break
-        except Exception:
-            if attempt+1 == retries:
-                raise
-            time.sleep(0.2)
-
-    # Convert scene_results -> problem_fragments
-    converted=[]
-    scene_results=[]
-    if isinstance(parsed_s1,dict) and isinstance(parsed_s1.get("scene_results"),list):
-        scene_results = parsed_s1["scene_results"]
-    elif isinstance(parsed_s1,list):
-        scene_results = parsed_s1
-
-    for sr in scene_results:
-        if not isinstance(sr,dict): continue
-        sc_id=sr.get("scID")
-        if sc_id != 0: continue
-        snts=sr.get("snt",[])
-        packed=[]
-        for item in snts:
-            if not isinstance(item,dict): continue
-            sid=item.get("id")
-            if sid is None: continue
-            vlc=item.get("vlc",[])
-            text_val=sentences[sid] if sid < len(sentences) else ""
-            norm=_collect_stage1_labels(vlc, text_val)
-            if norm or vlc==[]:
-                packed.append({"id":sid,"text":text_val,"violations":norm})
-        if packed and not any(p["violations"] for p in packed):
-            packed[0]["violations"]=[{"label":"MILD_CONFLICT","conf":60}]
-        if packed:
-            converted.append({"scene_index":0,"sentences":packed})
-
-    pf_add = build_problem_fragments_from_compact(converted, scenes)
-    problem_fragments.extend(pf_add)
-
-    # Defaults in evidence + severity_local
-    finalize_evidence_fields(problem_fragments)
-
-    # ---------- Stage 2 ----------
-    # Build queries with small context (prev, next)
-    queries=[]
-    for pf in problem_fragments:
-        scID=pf["scene_index"]; sid=pf["sentence_index"]
-        pt=""; nt=""
-        if sid-1>=0: pt=scene["sentences"][sid-1].get("text","")
-        if sid+1<len(scene["sentences"]): nt=scene["sentences"][sid+1].get("text","")
-        queries.append({"scID": scID, "id": sid, "pt": pt, "t": pf["text"], "nt": nt, "vlc": pf["labels"]})
-
-    prompt_s2,_ = build_stage2_conversation(queries, encoding, llm_effort_s2)
-    raw_s2=""; parsed_s2=None
-    gen2={
-        "prompt": prompt_s2,
-        "temperature": _effort_temperature(llm_effort_s2),
-        "max_tokens": 4096,
-        "top_p": 0.3,
-        "repeat_penalty": 1.05,
-        "seed": 202
-    }
-    for attempt in range(max(1,retries)):
-        try:
-            resp2=llm.create_completion(**gen2)
-            raw_s2=resp2["choices"][0].get("text","")
-            parsed_s2=parse_llm_response(raw_s2, encoding, effort=llm_effort_s2,
-                                         debug_dir=debug_dir, prefer="ans")
-            break
-        except Exception:
-            if attempt+1==retries:
-                raise
-            time.sleep(0.2)
+    frags_by_scene: List[List[Dict]] = [[] for _ in scenes]
+    for problem_fragments in batch_frags:
+        for pf in problem_fragments:
+            frags_by_scene[pf["scene_index"]].append(pf)
 
-    ans_full=ensure_stage2_backfill(queries, parsed_s2)
-    problem_fragments=apply_stage2(ans_full, problem_fragments)
-    finalize_evidence_fields(problem_fragments)
+    processing_time=time.time()-start
+    reports=[]
+    for problem_fragments in frags_by_scene:
+        parents_guide=aggregate_parents_guide(problem_fragments)
+        reports.append({
+            "document": document_name,
+            "final_rating": _infer_final_rating(parents_guide),
+            "scenes_total": 1,
+            "parents_guide": parents_guide,
+            "problem_fragments": problem_fragments,
+            "processing_seconds": round(processing_time,2)
+        })
+    return reports
 
-    parents_guide=aggregate_parents_guide(problem_fragments)
-    final_rating=_infer_final_rating(parents_guide)
 
-    processing_time=time.time()-start
-    report={
-        "document": document_name,
-        "final_rating": final_rating,
-        "scenes_total": 1,
-        "parents_guide": parents_guide,
-        "problem_fragments": problem_fragments,
-        "processing_seconds": round(processing_time,2)
-    }
-
-    return report
\ No newline at end of file
+def analyze_single_scene(
+    scene_input: Dict[str, Any],
+    *,
+    document_name: str = "single_scene",
+    repo_id: str = "unsloth/gpt-oss-20b-GGUF",
+    filename: str = "gpt-oss-20b-F16.gguf",
+    model_path: Optional[str] = None,
+    n_ctx: int = 6000,
+    n_gpu_layers: int = -1,
+    llm_effort_s1: str = "low",
+    llm_effort_s2: str = "low",
+    retries: int = 3,
+    debug_dir: Optional[str] = None,
+    seed_stage1: int = 101,
+    seed_stage2: int = 202,
+    kv_cache_mb: int = 0
+) -> Dict[str, Any]:
+    return analyze_scenes(
+        [scene_input],
+        document_name=document_name,
+        repo_id=repo_id,
+        filename=filename,
+        model_path=model_path,
+        n_ctx=n_ctx,
+        n_gpu_layers=n_gpu_layers,
+        llm_effort_s1=llm_effort_s1,
+        llm_effort_s2=llm_effort_s2,
+        retries=retries,
+        debug_dir=debug_dir,
+        seed_stage1=seed_stage1,
+        seed_stage2=seed_stage2,
+        kv_cache_mb=kv_cache_mb
+    )[0]
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import re
-from typing import Dict, List, Any, Set
+from typing import Dict, List, Any, FrozenSet
 
 # --------------------------------------------------
 # Основной список меток
@@ -53,11 +53,11 @@ SEV_MAP_STR2INT = {"none": 0, "mild": 1, "moderate": 2, "severe": 3}
 # --------------------------------------------------
 # Жёсткие 18+ метки
 # --------------------------------------------------
-HARD_18_LABELS: Set[str] = {
+HARD_18_LABELS: FrozenSet[str] = frozenset({
     "VIOLENCE_GRAPHIC", "SEXUAL_VIOLENCE", "SEX_EXPLICIT", "DRUGS_USE_DEPICTION",
     "CRIME_INSTRUCTIONS", "PROFANITY_OBSCENE", "MEDICAL_GORE_DETAILS", "SUICIDE_SELF_HARM",
     "ABUSE_HATE_EXTREMISM", "EXTREMISM_PROPAGANDA", "NAZISM_PROPAGANDA", "FASCISM_PROPAGANDA"
-}
+})
 
 # --------------------------------------------------
 # Порядок рейтингов
@@ -178,6 +178,8 @@ _PROFANITY_ROOT_PATTERNS: List[re.Pattern] = [
     re.compile(r"хуе|хуй|хуя", re.IGNORECASE),
     re.compile(r"шлюх", re.IGNORECASE),
 ]
+# Все корни одной альтернацией: один проход по строке вместо поиска каждым шаблоном
+_PROFANITY_ALT: re.Pattern = re.compile("|".join(f"(?:{p.pattern})" for p in _PROFANITY_ROOT_PATTERNS), re.IGNORECASE)
 
 # --------------------------------------------------
 # Алиасы нормализации меток
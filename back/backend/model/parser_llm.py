@@ -10,16 +10,24 @@ try:
 except Exception:
     _HAS_DEMJSON = False
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def _maybe_dump(ddir: Optional[str], fname: str, content: Any):
     if not ddir: return
     try:
         os.makedirs(ddir, exist_ok=True)
+        if isinstance(content,(dict,list)):
+            if orjson is not None:
+                with open(os.path.join(ddir, fname), "wb") as f:
+                    f.write(orjson.dumps(content, option=orjson.OPT_INDENT_2))
+                return
+            content=json.dumps(content,ensure_ascii=False,indent=2)
         with open(os.path.join(ddir, fname), "w", encoding="utf-8") as f:
-            if isinstance(content,(dict,list)):
-                json.dump(content,f,ensure_ascii=False,indent=2)
-            else:
-                f.write(str(content))
+            f.write(str(content))
     except Exception:
         pass
 
@@ -120,6 +128,25 @@ def _balanced_slice(text: str, start: int)->Optional[str]:
                 return text[i:j+1]
     return text[i:] if stack else None
 
+_FINAL_HEADER_RE = re.compile(r"<\|channel\|\>\s*final\s*<\|message\|\>", re.I)
+
+def has_complete_final_json(raw: str, key: str)->bool:
+    """
+    True once the final channel already holds a closed JSON object with `key` (strict json, no brace
+    auto-closing). Only the text after the last final-channel header is checked: the analysis channel
+    often drafts the same object before the answer starts.
+    """
+    m=None
+    for m in _FINAL_HEADER_RE.finditer(raw): pass
+    if m is None: return False
+    frag=_balanced_slice(raw, m.end())
+    if not frag or frag[0]!="{" or frag[-1]!="}": return False
+    try:
+        obj=json.loads(frag)
+    except ValueError:
+        return False
+    return isinstance(obj,dict) and key in obj
+
 def _find_regions(s: str)->List[str]:
     out=[]; idx=0; n=len(s)
     while idx<n:
@@ -316,7 +343,9 @@ def _fallback_extract_stage0_non_neutral(s: str)->Optional[Dict]:
     return None
 
 def parse_llm_response(raw: str, encoding=None, effort: str="low", debug_dir: Optional[str]=None, prefer: Optional[str]=None) -> Dict:
-    _maybe_dump(debug_dir,"raw.txt", raw)
+    # the parser is on the hot path of every stage: with dumps off no dump call is made at all
+    dump=bool(debug_dir)
+    if dump: _maybe_dump(debug_dir,"raw.txt", raw)
     stripped=_base_clean(raw)
     candidates=[]
     m_final=re.search(r"<\|channel\|\>\s*final\s*<\|message\|\>", raw or "", re.I)
@@ -348,20 +377,20 @@ def parse_llm_response(raw: str, encoding=None, effort: str="low", debug_dir: Op
             if obj is not None:
                 obj=_normalize(obj)
                 parsed_list.append((_score(obj, prefer), obj, repaired))
-                _maybe_dump(debug_dir,f"candidate_ok_{idx}.json", obj)
+                if dump: _maybe_dump(debug_dir,f"candidate_ok_{idx}.json", obj)
                 break
         if obj is None:
-            _maybe_dump(debug_dir,f"candidate_fail_{idx}.txt", repaired)
+            if dump: _maybe_dump(debug_dir,f"candidate_fail_{idx}.txt", repaired)
 
     if not parsed_list:
         fb2=_fallback_extract_stage2_ans(stripped)
         if fb2:
             fb2=_normalize(fb2)
-            _maybe_dump(debug_dir, "fallback_stage2_ans.json", fb2)
+            if dump: _maybe_dump(debug_dir, "fallback_stage2_ans.json", fb2)
             return fb2
         fb0=_fallback_extract_stage0_non_neutral(stripped)
         if fb0:
-            _maybe_dump(debug_dir, "fallback_stage0_non_neutral.json", fb0)
+            if dump: _maybe_dump(debug_dir, "fallback_stage0_non_neutral.json", fb0)
             return fb0
         raise ValueError("Could not parse any JSON from LLM output.")
 
@@ -369,8 +398,8 @@ def parse_llm_response(raw: str, encoding=None, effort: str="low", debug_dir: Op
     if prefer:
         for _,obj,_txt in parsed_list:
             if prefer in obj:
-                _maybe_dump(debug_dir,"chosen.json", obj)
+                if dump: _maybe_dump(debug_dir,"chosen.json", obj)
                 return obj
     best=parsed_list[0][1]
-    _maybe_dump(debug_dir,"chosen.json", best)
+    if dump: _maybe_dump(debug_dir,"chosen.json", best)
     return best
\ No newline at end of file
@@ -1,9 +1,16 @@
 from __future__ import annotations
-import argparse, json, os, re, sys, time
-from typing import Any, Dict, List, Optional
+import argparse, hashlib, json, os, re, struct, sys, time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, FrozenSet, Iterable, Iterator, List, Optional, Tuple, Union
 
+import numpy as np
 from tqdm import tqdm
 from llama_cpp import Llama
+try:
+    from llama_cpp import LlamaRAMCache
+except ImportError:
+    LlamaRAMCache=None
 
 from constants import (
     LABELS, THEMATIC_GROUPS, SEVERITY_WEIGHT, SEV_MAP_INT2STR, SEV_MAP_STR2INT,
@@ -12,7 +19,7 @@ from constants import (
     CONDEMNATION_TOKENS, FAMILY_TOKENS, COMEDY_TOKENS, GRAPHIC_TOKENS, AROUSAL_TOKENS,
     _PROFANITY_ROOT_PATTERNS, _ALIAS_MAP
 )
-from parser_llm import parse_llm_response
+from parser_llm import has_complete_final_json, parse_llm_response
 
 # Harmony (optional)
 try:
@@ -32,8 +39,20 @@ except Exception:
     SystemContent=Dummy
     ReasoningEffort=Dummy
 
+try:
+    import orjson
+except ImportError:
+    orjson=None
+
 
 # ---------------- Utility ----------------
+def _json_bytes(obj: Any)->bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj,ensure_ascii=False,separators=(",",":")).encode("utf-8")
+
+_LABELS_JSON_B=_json_bytes(LABELS)
+
 def _maybe_dump(ddir: Optional[str], fname: str, content: Any):
     if not ddir: return
     try:
@@ -72,90 +91,106 @@ def _effort_temperature(effort: str)->float:
     e=(effort or "low").lower()
     return 0.15 if e=="high" else (0.08 if e=="medium" else 0.01)
 
+# ---------------- Harmony rendering ----------------
+# Строка (без Harmony) или готовые token ids: llama.cpp принимает оба варианта в create_completion,
+# поэтому промпт не декодируется обратно в текст и не токенизируется повторно.
+Prompt=Union[str,List[int]]
+
+_HARMONY_FRAME_CACHE: Dict[tuple,Tuple[List[int],List[int]]]={}
+
+def _harmony_frame(encoding, llm_effort: str)->Tuple[List[int],List[int]]:
+    """Токены system-сообщения и хвоста `<|start|>assistant`; неизменны для пары (encoding, effort)."""
+    key=(id(encoding), llm_effort)
+    frame=_HARMONY_FRAME_CACHE.get(key)
+    if frame is None:
+        sysc=SystemContent.new().with_reasoning_effort(_effort_to_reasoning(llm_effort)).with_required_channels(["final"])
+        sys_convo=Conversation.from_messages([Message.from_role_and_content(Role.SYSTEM, sysc)])
+        head=list(encoding.render_conversation(sys_convo))
+        full=encoding.render_conversation_for_completion(sys_convo, Role.ASSISTANT)
+        frame=(head, list(full[len(head):]))
+        _HARMONY_FRAME_CACHE[key]=frame
+    return frame
+
+def _render_harmony_tokens(user_content: str, encoding, llm_effort: str)->List[int]:
+    head, tail = _harmony_frame(encoding, llm_effort)
+    return head + list(encoding.render(Message.from_role_and_content(Role.USER, user_content))) + tail
+
 # ---------------- Stage 0 (prefilter) ----------------
 def _scene_preview(scene: Dict[str,Any], max_sentences: int)->Dict[str,Any]:
     sents=scene.get("sentences",[]) or []
-    texts=[s.get("text","") for s in sents if isinstance(s,dict)]
-    if max_sentences>0 and len(texts)>max_sentences:
+    # режем голову/хвост до материализации текстов, середину длинной сцены не трогаем
+    if max_sentences>0 and len(sents)>max_sentences:
         head=max_sentences//2
         tail=max_sentences - head
-        texts = texts[:head] + texts[-tail:]
+        sents = sents[:head] + sents[-tail:]
+    texts=[s.get("text","") for s in sents if isinstance(s,dict)]
     return {"scene_index": scene["scene_index"], "sentences": texts, "heading": scene.get("heading","")}
 
-def build_stage0_conversation(scenes_batch: List[Dict], encoding, llm_effort: str, max_sentences: int)->tuple[str,List[str]]:
+# Инструкции не зависят от батча: префикс собирается один раз при импорте
+_STAGE0_PREFIX=(
+    "You are a fast triage assistant for Russian screenplay scenes.\n"
+    "Return ONLY JSON: {\"non_neutral\":[int,...]} with indices of scenes that likely contain ANY listed categories.\n"
+    "Be INCLUSIVE: if uncertain, include the index. Do NOT output texts."
+    "\nCategories:"+", ".join(LABELS)+"\nInput:"
+)
+
+def build_stage0_conversation(scenes_batch: List[Dict], encoding, llm_effort: str, max_sentences: int,
+                              prefix: str="")->tuple[Prompt,List[str]]:
     previews=[_scene_preview(sc, max_sentences) for sc in scenes_batch]
-    instruction=(
-        "You are a fast triage assistant for Russian screenplay scenes.\n"
-        "Return ONLY JSON: {\"non_neutral\":[int,...]} with indices of scenes that likely contain ANY listed categories.\n"
-        "Be INCLUSIVE: if uncertain, include the index. Do NOT output texts."
-    )
-    user_content=instruction+"\nCategories:"+", ".join(LABELS)+"\nInput:"+json.dumps(previews,ensure_ascii=False)
+    user_content=(prefix or _STAGE0_PREFIX)+json.dumps(previews,ensure_ascii=False)
     if HARMONY_AVAILABLE and encoding:
-        sysc=SystemContent.new().with_reasoning_effort(_effort_to_reasoning(llm_effort)).with_required_channels(["final"])
-        convo=Conversation.from_messages([
-            Message.from_role_and_content(Role.SYSTEM, sysc),
-            Message.from_role_and_content(Role.USER, user_content)
-        ])
-        tokens=encoding.render_conversation_for_completion(convo, Role.ASSISTANT)
-        return encoding.decode(tokens), []
+        return _render_harmony_tokens(user_content, encoding, llm_effort), []
     return user_content, []
 
 # ---------------- Stage 1 prompt ----------------
-def build_stage1_conversation(batch: List[Dict], encoding, llm_effort: str="low")->tuple[str,List[str]]:
+_STAGE1_INSTRUCTION=(
+    "You analyze Russian screenplay sentences. Return ONLY JSON:\n"
+    "{\"scene_results\":[{\"scID\":int,\"snt\":[{\"id\":int,\"vlc\":[{\"label\":string,\"conf\":int}]}]}]}\n"
+    "MANDATORY: Each scene MUST have at least ONE sentence with at least ONE label. If all are neutral, assign MILD_CONFLICT to the most contextually active sentence.\n"
+    "Gates:\n"
+    "- VIOLENCE_GRAPHIC: explicit gore/blood/wounds/torture only.\n"
+    "- MURDER_HOMICIDE: clear attempt or commission.\n"
+    "- DRUGS_USE_DEPICTION: explicit HUMAN illegal/controlled drug consumption or explicit name of such drug.\n"
+    "- PROFANITY_OBSCENE: only if sentence contains obscene root (-бзд-;-бля-;-(ё/е)б-;-елд-;-говн-;-жоп-;-манд-;-муд-;-перд-;-пизд-;-сра-;-(с)са-;-хуе-/-хуй-/-хуя-;-шлюх-).\n"
+    "Confidence 0..100. Do NOT include original texts back. final-only."
+)
+_STAGE1_PREFIX=_STAGE1_INSTRUCTION.encode("utf-8")+b"\nAllowed labels:"+_LABELS_JSON_B+b"\nInput:"
+
+def build_stage1_conversation(batch: List[Dict], encoding, llm_effort: str="low",
+                              prefix: bytes=b"")->tuple[Prompt,List[str]]:
     payload=[]
     for s in batch:
         sc_id=s["scene_index"]
         sents=[{"id":i,"t":sent.get("text","")} for i,sent in enumerate(s.get("sentences",[]))]
         payload.append({"scID":sc_id,"snt":sents})
-    instruction=(
-        "You analyze Russian screenplay sentences. Return ONLY JSON:\n"
-        "{\"scene_results\":[{\"scID\":int,\"snt\":[{\"id\":int,\"vlc\":[{\"label\":string,\"conf\":int}]}]}]}\n"
-        "MANDATORY: Each scene MUST have at least ONE sentence with at least ONE label. If all are neutral, assign MILD_CONFLICT to the most contextually active sentence.\n"
-        "Gates:\n"
-        "- VIOLENCE_GRAPHIC: explicit gore/blood/wounds/torture only.\n"
-        "- MURDER_HOMICIDE: clear attempt or commission.\n"
-        "- DRUGS_USE_DEPICTION: explicit HUMAN illegal/controlled drug consumption or explicit name of such drug.\n"
-        "- PROFANITY_OBSCENE: only if sentence contains obscene root (-бзд-;-бля-;-(ё/е)б-;-елд-;-говн-;-жоп-;-манд-;-муд-;-перд-;-пизд-;-сра-;-(с)са-;-хуе-/-хуй-/-хуя-;-шлюх-).\n"
-        "Confidence 0..100. Do NOT include original texts back. final-only."
-    )
-    user_content=instruction+"\nAllowed labels:"+json.dumps(LABELS,ensure_ascii=False)+"\nInput:"+json.dumps(payload,ensure_ascii=False)
+    buf=bytearray(prefix or _STAGE1_PREFIX)
+    buf+=_json_bytes(payload)
+    user_content=buf.decode("utf-8")
     if HARMONY_AVAILABLE and encoding:
-        sysc=SystemContent.new().with_reasoning_effort(_effort_to_reasoning(llm_effort)).with_required_channels(["final"])
-        convo=Conversation.from_messages([
-            Message.from_role_and_content(Role.SYSTEM, sysc),
-            Message.from_role_and_content(Role.USER, user_content)
-        ])
-        tokens=encoding.render_conversation_for_completion(convo, Role.ASSISTANT)
-        return encoding.decode(tokens), []
+        return _render_harmony_tokens(user_content, encoding, llm_effort), []
     return user_content, []
 
 # ---------------- Stage 2 prompt ----------------
-def build_stage2_conversation(q_batch: List[Dict], encoding, llm_effort: str="low")->tuple[str,List[str]]:
-    instruction=(
-        "You rate Russian screenplay sentences. Return ONLY JSON:\n"
-        "{\"ans\":[{\"scID\":int,\"id\":int,\"det\":[{\"label\":string,\"sev\":\"Mild|Moderate|Severe\",\"scr\":int,\"rsn\":string,\"adv\":string,\"ok\":boolean,\"suggest\":string|null}]}]}\n"
-        "FOR EACH input label produce a det object. Use allowed labels exactly. Profanity only if obscene roots.\n"
-        "Drugs depiction only explicit illegal human use; else ok=false suggest DRUGS_MENTION_NON_DETAILED/REMOVE.\n"
-        "sev from th; scr from bs (+/- brief rationale).Пиши reason и advice на русском языке\nfinal-only."
-    )
-    user_payload={"fw":FW_RULES,"Queries":q_batch}
-    user_content=instruction+"\n"+json.dumps(user_payload,ensure_ascii=False)
+_STAGE2_INSTRUCTION=(
+    "You rate Russian screenplay sentences. Return ONLY JSON:\n"
+    "{\"ans\":[{\"scID\":int,\"id\":int,\"det\":[{\"label\":string,\"sev\":\"Mild|Moderate|Severe\",\"scr\":int,\"rsn\":string,\"adv\":string,\"ok\":boolean,\"suggest\":string|null}]}]}\n"
+    "FOR EACH input label produce a det object. Use allowed labels exactly. Profanity only if obscene roots.\n"
+    "Drugs depiction only explicit illegal human use; else ok=false suggest DRUGS_MENTION_NON_DETAILED/REMOVE.\n"
+    "sev from th; scr from bs (+/- brief rationale).Пиши reason и advice на русском языке\nfinal-only."
+)
+_STAGE2_PREFIX=_STAGE2_INSTRUCTION.encode("utf-8")+b"\n"
+
+def build_stage2_conversation(q_batch: List[Dict], encoding, llm_effort: str="low",
+                              prefix: bytes=b"")->tuple[Prompt,List[str]]:
+    buf=bytearray(prefix or _STAGE2_PREFIX)
+    buf+=_json_bytes({"fw":FW_RULES,"Queries":q_batch})
+    user_content=buf.decode("utf-8")
     if HARMONY_AVAILABLE and encoding:
-        sysc=SystemContent.new().with_reasoning_effort(_effort_to_reasoning(llm_effort)).with_required_channels(["final"])
-        convo=Conversation.from_messages([
-            Message.from_role_and_content(Role.SYSTEM, sysc),
-            Message.from_role_and_content(Role.USER, user_content)
-        ])
-        tokens=encoding.render_conversation_for_completion(convo, Role.ASSISTANT)
-        return encoding.decode(tokens), []
+        return _render_harmony_tokens(user_content, encoding, llm_effort), []
     return user_content, []
 
 # ---------------- Stage 3 prompt (soft) ----------------
-def build_stage3_conversation(law_rules_obj: Dict[str, Any],
-                              violated_sentences: List[Dict[str, Any]],
-                              encoding,
-                              llm_effort: str="medium")->tuple[str,List[str]]:
-    instruction = (
+_STAGE3_INSTRUCTION=(
         "You are an expert on the Federal Law of the Russian Federation No. 436-FZ. Your task is to assign "
 " THE LEAST acceptable age rating (0+, 6+, 12+, 16+, 18+). "
 "Return ONLY JSON: {\"final_rating\":\"0+|6+|12+|16+|18+\",\"explanation\":string}.\n\n"
@@ -188,20 +223,26 @@ def build_stage3_conversation(law_rules_obj: Dict[str, Any],
 "If you upgraded to 18+, specify the specific reason for item 2.\n\n"
 "Input: JSON with categories of the law and a list of infringing sentences with context. "
     "Rely on the law, but the goal is TO ASSIGN THE LOWEST ACCEPTABLE rating. Пиши explanation на русском языке\n"
-    )
+)
+_STAGE3_PREFIX=_STAGE3_INSTRUCTION+"\nInput:"
+
+def build_stage3_conversation(law_rules_obj: Dict[str, Any],
+                              violated_sentences: List[Dict[str, Any]],
+                              encoding,
+                              llm_effort: str="medium",
+                              prefix: str="")->tuple[Prompt,List[str]]:
     payload={"law_categories":law_rules_obj,"violated_sentences":violated_sentences}
-    user_content=instruction+"\nInput:"+json.dumps(payload,ensure_ascii=False)
+    user_content=(prefix or _STAGE3_PREFIX)+json.dumps(payload,ensure_ascii=False)
     if HARMONY_AVAILABLE and encoding:
-        sysc=SystemContent.new().with_reasoning_effort(_effort_to_reasoning(llm_effort)).with_required_channels(["final"])
-        convo=Conversation.from_messages([
-            Message.from_role_and_content(Role.SYSTEM, sysc),
-            Message.from_role_and_content(Role.USER, user_content)
-        ])
-        tokens=encoding.render_conversation_for_completion(convo, Role.ASSISTANT)
-        return encoding.decode(tokens), []
+        return _render_harmony_tokens(user_content, encoding, llm_effort), []
     return user_content, []
 
 # ---------------- Stage 1 helpers ----------------
+# первая метка пары -> конкуренты; при равном conf побеждает первая
+_EXCL_INDEX: Dict[str,List[str]]={}
+for _a,_b in S1_EXCLUSIVE_PAIRS:
+    _EXCL_INDEX.setdefault(_a,[]).append(_b)
+
 def _collect_stage1_labels(vlc_list: List[Any], sentence_text: str)->List[Dict[str,Any]]:
     best={}
     for v in (vlc_list or []):
@@ -219,17 +260,22 @@ def _collect_stage1_labels(vlc_list: List[Any], sentence_text: str)->List[Dict[s
         c=int(conf) if isinstance(conf,(int,float)) else 0
         if lab not in best or c>best[lab]:
             best[lab]=c
-    for a,b in S1_EXCLUSIVE_PAIRS:
-        if a in best and b in best:
-            if best[a]>=best[b]: del best[b]
-            else: del best[a]
+    if len(best)>=2:
+        for lab in list(best):
+            for peer in _EXCL_INDEX.get(lab, ()):
+                if lab in best and peer in best:
+                    best.pop(peer if best[lab]>=best[peer] else lab, None)
     return [{"label":lab,"conf":best[lab]} for lab in best]
 
-def build_problem_fragments_from_compact(compact_items: List[Dict], all_scenes: List[Dict])->List[Dict]:
+def build_problem_fragments_from_compact(compact_items: List[Dict], all_scenes: List[Dict],
+                                        scenes_by_id: Optional[Dict[int,Dict]]=None)->List[Dict]:
+    if scenes_by_id is None:
+        scenes_by_id={s["scene_index"]: s for s in all_scenes}
     frags=[]
     for scene in compact_items:
         sc_id=scene["scene_index"]
-        heading=next((s.get("heading","") for s in all_scenes if s["scene_index"]==sc_id),"")
+        sc=scenes_by_id.get(sc_id)
+        heading=sc.get("heading","") if sc else ""
         for s_item in scene.get("sentences",[]):
             viols=s_item.get("violations",[])
             labels=[v.get("label") for v in viols if v.get("label")]
@@ -254,11 +300,17 @@ def build_problem_fragments_from_compact(compact_items: List[Dict], all_scenes:
             })
     return frags
 
-def _severity_from_base_score(base: int)->str:
+def _severity_from_base_score_slow(base: int)->str:
     for name,(lo,hi) in FW_RULES["th"].items():
         if lo<=base<=hi: return name
     return "Severe" if base>=80 else ("Moderate" if base>=50 else ("Mild" if base>=25 else "None"))
 
+# шкала 0..100 ограничена, поэтому пороги FW_RULES["th"] разворачиваются в таблицу один раз
+_BASE_SEV_TABLE=[_severity_from_base_score_slow(i) for i in range(101)]
+
+def _severity_from_base_score(base: int)->str:
+    return _BASE_SEV_TABLE[max(0, min(100, base))]
+
 def finalize_evidence_fields(problem_fragments: List[Dict])->None:
     for pf in problem_fragments:
         ev=pf.get("evidence_spans",{})
@@ -376,26 +428,29 @@ def ensure_stage2_backfill(q_batch: List[Dict], parsed2: Optional[Dict]) -> List
     return full_ans
 
 def apply_stage2(full_ans: List[Dict], problem_fragments: List[Dict], debug_dir: Optional[str])->List[Dict]:
-    det_map={(a.get("scID"), a.get("id")): a.get("det",[]) for a in full_ans}
+    # метки нормализуются один раз при построении индекса, а не на каждый фрагмент
+    det_map={(a.get("scID"), a.get("id")): [(lab, d) for d in a.get("det",[]) if (lab:=normalize_label(d.get("label")))]
+             for a in full_ans}
     out=[]
     removal=[]
     for pf in problem_fragments:
         key=(pf["scene_index"], pf["sentence_index"])
-        if key not in det_map:
+        dets=det_map.get(key)
+        if dets is None:
             out.append(pf); continue
         ev=pf.get("evidence_spans",{})
         labels=list(pf.get("labels") or [])
+        labels_set=set(labels)
         adv_acc=[]
-        for d in det_map[key]:
-            lab=normalize_label(d.get("label"))
-            if not lab: continue
+        for lab, d in dets:
             if d.get("ok") is False and (d.get("suggest") in ("REMOVE","remove")):
-                if lab in labels: labels=[x for x in labels if x!=lab]
+                if lab in labels_set:
+                    labels=[x for x in labels if x!=lab]; labels_set.discard(lab)
                 if lab in ev: ev.pop(lab,None)
                 removal.append({"scene_index":pf["scene_index"],"sentence_index":pf["sentence_index"],"removed_label":lab})
                 continue
-            if lab not in labels:
-                labels.append(lab)
+            if lab not in labels_set:
+                labels.append(lab); labels_set.add(lab)
                 ev[lab]={"severity":"", "score":None, "reason":"", "advice":None, "trigger":None}
             if lab in ev:
                 if d.get("sev"): ev[lab]["severity"]=d["sev"]
@@ -469,22 +524,21 @@ def _groups_for_labels(labels: List[str])->List[str]:
     return sorted(set(groups))
 
 # ---------------- Rating guard logic ----------------
+_RATING_IDX={r:i for i,r in enumerate(ORDERED_RATINGS)}
+
 def _minimal_needed_rating(packed_items: List[Dict]) -> str:
-    all_labels=[]
     soft_any={"condemnation":False,"family_context":False,"comedy":False,"low_detail":True}
-    counts={}
+    counts=Counter()
     for it in packed_items:
         for k,v in it.get("softeners",{}).items():
             if k in soft_any:
                 soft_any[k] = soft_any[k] or v
         for l in it.get("labels",[]):
-            all_labels.append(l)
-            counts[l]=counts.get(l,0)+1
-    label_set=set(all_labels)
-
-    # Hard 18+
-    if any(l in HARD_18_LABELS for l in label_set):
-        return "18+"
+            # Hard 18+: дальше считать нечего
+            if l in HARD_18_LABELS:
+                return "18+"
+            counts[l]+=1
+    label_set=counts.keys()
 
     # SEX_SUGGESTIVE логика
     if "SEX_SUGGESTIVE" in label_set:
@@ -525,56 +579,102 @@ def _minimal_needed_rating(packed_items: List[Dict]) -> str:
 
 def adjust_stage3_rating(model_rating: Optional[str], packed_items: List[Dict]) -> str:
     auto_min=_minimal_needed_rating(packed_items)
-    if model_rating not in ORDERED_RATINGS:
+    if model_rating not in _RATING_IDX:
         return auto_min
-    mr_i=ORDERED_RATINGS.index(model_rating)
-    min_i=ORDERED_RATINGS.index(auto_min)
-    if mr_i > min_i: return auto_min
-    if mr_i < min_i: return auto_min
-    return model_rating
+    mr_i=_RATING_IDX[model_rating]
+    min_i=_RATING_IDX[auto_min]
+    return auto_min if mr_i != min_i else model_rating
 
 # ---------------- Parents Guide aggregation ----------------
+_GROUP_LABEL_SETS: Dict[str,FrozenSet[str]]={g: frozenset(labs) for g,labs in THEMATIC_GROUPS.items()}
+
 def aggregate_parents_guide(problem_fragments: List[Dict], total_scenes:int)->Dict:
     guide={}
-    for group,labs in THEMATIC_GROUPS.items():
-        eps=[pf for pf in problem_fragments if any(l in labs for l in pf["labels"])]
-        if not eps:
+    n=len(problem_fragments)
+    frag_labels=[frozenset(pf["labels"]) for pf in problem_fragments]
+    sev_arr=np.fromiter((SEV_MAP_STR2INT.get(pf.get("severity_local","None").lower(),0) for pf in problem_fragments),
+                        dtype=np.int8, count=n)
+    for group,labs_set in _GROUP_LABEL_SETS.items():
+        mask=np.fromiter((not labs_set.isdisjoint(fl) for fl in frag_labels), dtype=bool, count=n)
+        eps_idx=np.flatnonzero(mask)
+        if not eps_idx.size:
             guide[group]={"severity":"None","episodes":0,"scenes_with_issues_percent":0.0,"examples":[]}
             continue
-        scenes_set={pf["scene_index"] for pf in eps}
-        max_sev=0
+        scenes_set={problem_fragments[i]["scene_index"] for i in eps_idx}
+        head=eps_idx[:5]
+        max_sev=int(sev_arr[head].max())
         examples=[]
-        for pf in eps[:5]:
-            sev_loc=pf.get("severity_local","None").lower()
-            sev_val=SEV_MAP_STR2INT.get(sev_loc,0)
-            max_sev=max(max_sev, sev_val)
+        for i in head:
+            pf=problem_fragments[i]
             examples.append({
                 "scene_index":pf["scene_index"],
                 "page":pf.get("page"),
                 "text":pf["text"],
-                "labels":[l for l in pf["labels"] if l in labs],
-                "severity_local":SEV_MAP_INT2STR.get(sev_val,"None")
+                "labels":[l for l in pf["labels"] if l in labs_set],
+                "severity_local":SEV_MAP_INT2STR.get(int(sev_arr[i]),"None")
             })
         guide[group]={
             "severity":SEV_MAP_INT2STR.get(max_sev,"None"),
-            "episodes":len(eps),
+            "episodes":int(eps_idx.size),
             "scenes_with_issues_percent":round(len(scenes_set)/max(total_scenes,1)*100,1),
             "examples":examples
         }
     return guide
 
+class GuideAccumulator:
+    """Инкрементальный parents_guide для списка, который только дописывается (Stage 1):
+    каждый новый фрагмент учитывается один раз, а не при каждой пересборке отчёта."""
+    def __init__(self, total_scenes: int):
+        self.total_scenes=total_scenes
+        self.seen=0
+        self.groups={g:{"episodes":0,"scenes":set(),"head":[]} for g in _GROUP_LABEL_SETS}
+
+    def update(self, problem_fragments: List[Dict])->None:
+        for pf in problem_fragments[self.seen:]:
+            fl=frozenset(pf["labels"])
+            for group,labs_set in _GROUP_LABEL_SETS.items():
+                if labs_set.isdisjoint(fl): continue
+                st=self.groups[group]
+                st["episodes"]+=1
+                st["scenes"].add(pf["scene_index"])
+                if len(st["head"])<5: st["head"].append(pf)
+        self.seen=len(problem_fragments)
+
+    def guide(self)->Dict:
+        guide={}
+        for group,labs_set in _GROUP_LABEL_SETS.items():
+            st=self.groups[group]
+            if not st["episodes"]:
+                guide[group]={"severity":"None","episodes":0,"scenes_with_issues_percent":0.0,"examples":[]}
+                continue
+            sevs=[SEV_MAP_STR2INT.get(pf.get("severity_local","None").lower(),0) for pf in st["head"]]
+            guide[group]={
+                "severity":SEV_MAP_INT2STR.get(max(sevs),"None"),
+                "episodes":st["episodes"],
+                "scenes_with_issues_percent":round(len(st["scenes"])/max(self.total_scenes,1)*100,1),
+                "examples":[{
+                    "scene_index":pf["scene_index"],
+                    "page":pf.get("page"),
+                    "text":pf["text"],
+                    "labels":[l for l in pf["labels"] if l in labs_set],
+                    "severity_local":SEV_MAP_INT2STR.get(sev,"None")
+                } for pf,sev in zip(st["head"],sevs)]
+            }
+        return guide
+
+_FINAL_BY_SEV={3:"18+",2:"16+",1:"12+",0:None}
+
 def assemble_report(document_name: str, total_scenes:int, problem_fragments: List[Dict],
                     processing_time: float, final_rating_override: Optional[str]=None,
-                    model_explanation: Optional[str]=None, model_final_rating: Optional[str]=None)->Dict:
-    parents_guide=aggregate_parents_guide(problem_fragments,total_scenes)
+                    model_explanation: Optional[str]=None, model_final_rating: Optional[str]=None,
+                    parents_guide: Optional[Dict]=None)->Dict:
+    if parents_guide is None:
+        parents_guide=aggregate_parents_guide(problem_fragments,total_scenes)
     if final_rating_override in ORDERED_RATINGS:
         final_rating=final_rating_override
     else:
-        max_sev=0
-        for g in parents_guide.values():
-            sev=SEV_MAP_STR2INT.get(str(g.get("severity","")).lower(),0)
-            max_sev=max(max_sev, sev)
-        final_rating="18+" if max_sev>=3 else ("16+" if max_sev==2 else ("12+" if max_sev==1 else ("6+" if any(g.get("episodes",0)>0 for g in parents_guide.values()) else "0+")))
+        max_sev=max((SEV_MAP_STR2INT.get(str(g.get("severity","")).lower(),0) for g in parents_guide.values()), default=0)
+        final_rating=_FINAL_BY_SEV.get(max_sev) or ("6+" if any(g.get("episodes",0)>0 for g in parents_guide.values()) else "0+")
     out={
         "document":document_name,
         "final_rating":final_rating,
@@ -589,6 +689,215 @@ def assemble_report(document_name: str, total_scenes:int, problem_fragments: Lis
     return out
 
 # ---------------- Main ----------------
+CTX_MARGIN=256
+
+def _round_up(n: int, step: int)->int:
+    return -(-n//step)*step
+
+def _prompt_len(llm: Llama, prompt: Prompt)->int:
+    if isinstance(prompt, list):
+        return len(prompt)
+    return len(llm.tokenize(prompt.encode("utf-8"), special=True))
+
+STAGE1_OUT_TOKENS_PER_SCENE=4096
+
+def _pack_by_token_budget(items: List[Dict], costs: List[int], budget: int)->List[Tuple[int,List[Dict]]]:
+    """Жадно режет items на батчи суммарной стоимостью <= budget; возвращает (смещение, батч)."""
+    batches=[]; cur=[]; cur_cost=0; start=0
+    for i,(it,c) in enumerate(zip(items,costs)):
+        if cur and cur_cost+c>budget:
+            batches.append((start,cur))
+            cur=[]; cur_cost=0; start=i
+        cur.append(it); cur_cost+=c
+    if cur: batches.append((start,cur))
+    return batches
+
+def _report_bytes(report: Dict, pretty: bool=False)->bytes:
+    # orjson сериализует сразу в bytes (в разы быстрее json)
+    if orjson is not None:
+        return orjson.dumps(report, option=(orjson.OPT_INDENT_2 if pretty else 0)|orjson.OPT_NON_STR_KEYS)
+    return json.dumps(report,ensure_ascii=False,indent=2 if pretty else None).encode("utf-8")
+
+def _write_atomic(path: str, data: bytes)->None:
+    # пишем во временный файл и атомарно подменяем: читатель никогда не видит обрезанный JSON
+    tmp=path+".partial"
+    try:
+        with open(tmp,"wb") as f:
+            f.write(data)
+        os.replace(tmp,path)
+    except BaseException:
+        # не оставляем недописанный .partial рядом с последним валидным отчётом
+        try: os.remove(tmp)
+        except OSError: pass
+        raise
+
+def _dump_report(path: str, report: Dict, pretty: bool=False)->None:
+    _write_atomic(path, _report_bytes(report, pretty))
+
+RETRY_TEMPERATURE_STEP=0.1
+
+def _stream_completion(llm: Llama, gen: Dict[str,Any], stop_key: str)->str:
+    # генерация обрывается, как только final-канал ответа содержит закрытый объект с stop_key,
+    # вместо того чтобы декодировать до max_tokens
+    parts=[]; stream=llm.create_completion(**gen, stream=True)
+    try:
+        for chunk in stream:
+            piece=chunk["choices"][0].get("text","")
+            parts.append(piece)
+            if "}" in piece and has_complete_final_json("".join(parts), stop_key):
+                break
+    finally:
+        if hasattr(stream,"close"): stream.close()
+    return "".join(parts)
+
+def _complete_with_retries(llm: Llama, gen: Dict[str,Any], retries: int, tag: str,
+                           encoding, effort: str, debug_dir: Optional[str], prefer: str,
+                           stream: bool=False)->Tuple[str,Optional[Dict]]:
+    raw=""; parsed=None
+    gen=dict(gen)
+    for att in range(retries):
+        try:
+            if stream:
+                raw=_stream_completion(llm, gen, prefer)
+            else:
+                resp=llm.create_completion(**gen)
+                raw=resp["choices"][0].get("text","")
+        except Exception as ee:
+            # сбой бэкенда (OOM, обрыв) — повторяем тот же запрос с экспоненциальной паузой
+            print(f"[{tag}] attempt {att+1} failed: {ee}", file=sys.stderr)
+            # после последней попытки ждать нечего
+            if att+1<retries: time.sleep(0.3*2**att)
+            continue
+        try:
+            parsed=parse_llm_response(raw, encoding, effort=effort, debug_dir=debug_dir, prefer=prefer)
+            break
+        except Exception as ee:
+            # ответ не разбирается (ValueError/JSONDecodeError): тот же seed/temperature дадут тот же текст, поэтому меняем сэмплер
+            print(f"[{tag}] attempt {att+1} unparseable: {ee}", file=sys.stderr)
+            gen["seed"]=gen.get("seed",0)+7919
+            gen["temperature"]=gen.get("temperature",0)+RETRY_TEMPERATURE_STEP
+    return raw, parsed
+
+# ---------------- Stage 2 prompt cache ----------------
+# Ключ — хеш модели, промпта и параметров генерации без seed: повторный прогон того же сценария
+# (или совпавшие батчи) обслуживается с диска без обращения к модели; смена модели инвалидирует кеш.
+def _prompt_key(gen: Dict[str,Any], model_id: Any)->str:
+    h=hashlib.blake2b(digest_size=16)
+    h.update(repr(model_id).encode("utf-8"))
+    prompt=gen["prompt"]
+    h.update(prompt.encode("utf-8") if isinstance(prompt,str) else np.asarray(prompt,dtype=np.int64).tobytes())
+    h.update(_json_bytes({k:v for k,v in gen.items() if k not in ("prompt","seed")}))
+    return h.hexdigest()
+
+def _load_prompt_cache(path: Optional[str])->Dict[str,str]:
+    if not path: return {}
+    try:
+        with open(path,"r",encoding="utf-8") as f:
+            data=json.load(f)
+        return data if isinstance(data,dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def _save_prompt_cache(path: Optional[str], cache: Dict[str,str])->None:
+    if not path: return
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        _write_atomic(path, _json_bytes(cache))
+    except OSError as e:
+        print(f"[cache] save failed: {e}", file=sys.stderr)
+
+def _prefetched(jobs: Iterable[tuple], run: Callable[[tuple],Any], pool: ThreadPoolExecutor)->Iterator[tuple]:
+    """Отдаёт (job, run(job)); следующий job уже отправлен в pool, пока вызывающий обрабатывает текущий."""
+    pending=None
+    for job in jobs:
+        fut=pool.submit(run, job)
+        if pending is not None:
+            yield pending[0], pending[1].result()
+        pending=(job, fut)
+    if pending is not None:
+        yield pending[0], pending[1].result()
+
+# llama-cpp-python сообщает о нехватке VRAM под веса только как "Failed to load model from file"
+# (текст CUDA уходит в stderr-лог), поэтому при n_gpu_layers!=0 это тоже повод уменьшить offload
+_OOM_MARKERS=("out of memory","failed to allocate","failed to create llama_context","failed to load model from file")
+# число слоёв, если block_count не удалось прочитать из GGUF
+GPU_LAYERS_FALLBACK_BLOCKS=32
+
+# размеры скалярных типов GGUF (uint8..float64); 8 — строка, 9 — массив
+_GGUF_SCALAR={0:"<B",1:"<b",2:"<H",3:"<h",4:"<I",5:"<i",6:"<f",7:"<?",10:"<Q",11:"<q",12:"<d"}
+
+def _gguf_skip(f, vtype: int)->None:
+    if vtype==8:
+        n,=struct.unpack("<Q",f.read(8)); f.seek(n,1)
+    elif vtype==9:
+        etype,n=struct.unpack("<IQ",f.read(12))
+        if etype in _GGUF_SCALAR: f.seek(n*struct.calcsize(_GGUF_SCALAR[etype]),1)
+        else:
+            for _ in range(n): _gguf_skip(f, etype)
+    else:
+        f.seek(struct.calcsize(_GGUF_SCALAR[vtype]),1)
+
+def _gguf_block_count(path: str)->Optional[int]:
+    """`<arch>.block_count` из заголовка GGUF (метаданные читаются без загрузки весов)."""
+    try:
+        with open(path,"rb") as f:
+            if f.read(4)!=b"GGUF": return None
+            _ver,_n_tensors,n_kv=struct.unpack("<IQQ",f.read(20))
+            for _ in range(n_kv):
+                klen,=struct.unpack("<Q",f.read(8))
+                key=f.read(klen); vtype,=struct.unpack("<I",f.read(4))
+                if key.endswith(b".block_count") and vtype in _GGUF_SCALAR and vtype!=6:
+                    fmt=_GGUF_SCALAR[vtype]
+                    return int(struct.unpack(fmt,f.read(struct.calcsize(fmt)))[0])
+                _gguf_skip(f, vtype)
+    except (OSError, struct.error, KeyError):
+        pass
+    return None
+
+def _model_file(cfg: Dict[str,Any])->Optional[str]:
+    if "model_path" in cfg: return cfg["model_path"]
+    try:
+        # после первой попытки загрузки файл уже лежит в кеше HF — скачивания не будет
+        from huggingface_hub import hf_hub_download
+        return hf_hub_download(repo_id=cfg["repo_id"], filename=cfg["filename"])
+    except Exception:
+        return None
+
+def _is_oom(e: Exception)->bool:
+    msg=str(e).lower()
+    return any(m in msg for m in _OOM_MARKERS)
+
+def _try_build_llm(cfg: Dict[str,Any], n_ctx: int)->Llama:
+    if "repo_id" in cfg:
+        return Llama.from_pretrained(**cfg, n_ctx=n_ctx)
+    return Llama(**cfg, n_ctx=n_ctx)
+
+def _attach_kv_cache(llm: Llama, cache_mb: int)->None:
+    # llama.cpp сам переиспользует KV общего префикса с предыдущим вызовом; RAM-кеш хранит состояния
+    # (save_state/load_state) нескольких прошлых промптов и восстанавливает самое длинное совпадение
+    if cache_mb>0 and LlamaRAMCache is not None:
+        llm.set_cache(LlamaRAMCache(capacity_bytes=cache_mb<<20))
+
+def _build_llm(cfg: Dict[str,Any], n_ctx: int)->Llama:
+    # Частичный offload многократно медленнее полного: пробуем все слои на GPU и при нехватке памяти
+    # делим число слоёв пополам (после -1 — половина block_count модели). Найденное значение пишется
+    # в cfg и переиспользуется при пересборке.
+    while True:
+        try:
+            llm=_try_build_llm(cfg, n_ctx)
+            print(f"[llm] n_ctx={n_ctx} n_gpu_layers={cfg.get('n_gpu_layers')}", file=sys.stderr)
+            return llm
+        except Exception as e:
+            ngl=cfg.get("n_gpu_layers",0)
+            if not _is_oom(e) or ngl==0:
+                print("Model init failed:", e, file=sys.stderr); raise
+            if ngl<0:
+                path=_model_file(cfg)
+                cfg["n_gpu_layers"]=((path and _gguf_block_count(path)) or GPU_LAYERS_FALLBACK_BLOCKS)//2
+            else:
+                cfg["n_gpu_layers"]=ngl//2
+            print(f"[llm] load failed with n_gpu_layers={ngl} ({e}), retrying with {cfg['n_gpu_layers']}", file=sys.stderr)
+
 def main():
     ap=argparse.ArgumentParser(description="Multi-stage content rater with Stage 0 prefilter and soft Stage 3.")
     ap.add_argument("--input", default="sc.json")
@@ -598,9 +907,15 @@ def main():
     ap.add_argument("--filename", default="gpt-oss-20b-F16.gguf")
     ap.add_argument("--model-path", default=None)
     ap.add_argument("--n-ctx", type=int, default=12000)
+    # >0 — модель грузится один раз с max(n_ctx, max_ctx) на все стадии; 0 (по умолчанию) — контекст
+    # из --n-ctx, он расширяется только под Stage 3
+    ap.add_argument("--max-ctx", type=int, default=0)
     ap.add_argument("--n-gpu-layers", type=int, default=-1)
+    ap.add_argument("--kv-cache-mb", type=int, default=0)
     ap.add_argument("--batch-size", type=int, default=1)
     ap.add_argument("--retries", type=int, default=3)
+    ap.add_argument("--stage2-token-budget", type=int, default=0)
+    ap.add_argument("--stage2-max-tokens-per-query", type=int, default=1024)
     ap.add_argument("--llm-effort-s0", choices=["low","medium","high"], default="medium")
     ap.add_argument("--llm-effort-s1", choices=["low","medium","high"], default="medium")
     ap.add_argument("--llm-effort-s2", choices=["low","medium","high"], default="medium")
@@ -609,7 +924,12 @@ def main():
     ap.add_argument("--no-stage0-enable", dest="stage0_enable", action="store_false")
     ap.add_argument("--stage0-batch-size", type=int, default=6)
     ap.add_argument("--stage0-max-sentences", type=int, default=70)
+    ap.add_argument("--stage0-n-ctx", type=int, default=0)
+    ap.add_argument("--checkpoint-every", type=int, default=10)
+    ap.add_argument("--checkpoint-seconds", type=float, default=5.0)
     ap.add_argument("--debug-dir", default="debug_full")
+    # кеш ответов Stage 2 в debug-dir включается явно (для повторных прогонов при отладке)
+    ap.add_argument("--stage2-cache", action="store_true")
     args=ap.parse_args()
 
     encoding=load_harmony_encoding(HarmonyEncodingName.HARMONY_GPT_OSS) if HARMONY_AVAILABLE else None
@@ -620,6 +940,7 @@ def main():
         raise TypeError("Input must be list of scenes.")
     for i,sc in enumerate(scenes):
         sc["scene_index"]=i
+    scenes_by_id={s["scene_index"]: s for s in scenes}
 
     with open(args.law_file,"r",encoding="utf-8") as f:
         law=json.load(f)
@@ -627,53 +948,84 @@ def main():
     os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
     if args.debug_dir: os.makedirs(args.debug_dir, exist_ok=True)
     # init model
-    try:
-        if args.model_path:
-            llm=Llama(model_path=args.model_path, n_ctx=args.n_ctx, n_gpu_layers=args.n_gpu_layers, verbose=False)
-        else:
-            if hasattr(Llama,"from_pretrained"):
-                llm=Llama.from_pretrained(repo_id=args.repo_id, filename=args.filename,
-                                          n_ctx=args.n_ctx, n_gpu_layers=args.n_gpu_layers, verbose=False)
-            else:
-                llm=Llama(model_path=args.filename, n_ctx=args.n_ctx, n_gpu_layers=args.n_gpu_layers, verbose=False)
-    except Exception as e:
-        print("Model init failed:", e, file=sys.stderr); raise
+    if args.model_path:
+        llm_cfg={"model_path":args.model_path}
+    elif hasattr(Llama,"from_pretrained"):
+        llm_cfg={"repo_id":args.repo_id,"filename":args.filename}
+    else:
+        llm_cfg={"model_path":args.filename}
+    llm_cfg.update(n_gpu_layers=args.n_gpu_layers, verbose=False)
+    llm_ctx=max(args.n_ctx, args.max_ctx or 0)
+    # при отдельном контексте для Stage 0 основная модель грузится после него, чтобы не держать две копии в памяти
+    small_s0=bool(args.stage0_enable and args.stage0_n_ctx)
+    llm=None if small_s0 else _build_llm(llm_cfg, llm_ctx)
+    if llm is not None: _attach_kv_cache(llm, args.kv_cache_mb)
     start=time.time()
     problem_fragments: List[Dict]=[]
 
+    # Запись на диск (отладочные дампы, чекпоинты) уходит в фоновые потоки и не задерживает цикл генерации
+    io_pool=ThreadPoolExecutor(max_workers=4, thread_name_prefix="io")
+    def _dump(fname: str, content: Any)->None:
+        if args.debug_dir: io_pool.submit(_maybe_dump, args.debug_dir, fname, content)
+
+    # Промежуточный отчёт пишется не после каждого батча, а раз в N батчей или T секунд
+    last_ckpt=time.time(); batches_since_ckpt=0; ckpt_fut=None
+    doc_name=os.path.basename(args.input); n_scenes=len(scenes)
+    def _checkpoint(force: bool=False, guide_acc: Optional[GuideAccumulator]=None)->None:
+        nonlocal last_ckpt, batches_since_ckpt, ckpt_fut
+        batches_since_ckpt+=1
+        if not force and batches_since_ckpt<args.checkpoint_every and time.time()-last_ckpt<args.checkpoint_seconds:
+            return
+        parents_guide=None
+        if guide_acc is not None:
+            guide_acc.update(problem_fragments)
+            parents_guide=guide_acc.guide()
+        report=assemble_report(doc_name, n_scenes, problem_fragments, time.time()-start, parents_guide=parents_guide)
+        # сериализуем здесь: фрагменты мутируют дальше по пайплайну; предыдущая запись должна завершиться
+        data=_report_bytes(report)
+        if ckpt_fut is not None: ckpt_fut.result()
+        ckpt_fut=io_pool.submit(_write_atomic, args.output, data)
+        last_ckpt=time.time(); batches_since_ckpt=0
+
+    # Генерация идёт в отдельном потоке (llama.cpp отпускает GIL), а разбор/чекпоинт батча N
+    # выполняется в основном потоке, пока модель уже считает батч N+1.
+    gen_pool=ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm")
+
     # Stage 0
     selected_scene_indices=None
     if args.stage0_enable:
         nn_set=set()
-        with tqdm(total=len(scenes), desc="Stage 0") as pbar0:
+        temp0=_effort_temperature(args.llm_effort_s0)
+        llm0=_build_llm(llm_cfg, args.stage0_n_ctx) if small_s0 else llm
+        def _stage0_jobs():
             for b in range(0,len(scenes), args.stage0_batch_size):
                 batch=scenes[b:b+args.stage0_batch_size]
                 prompt0,_=build_stage0_conversation(batch, encoding, args.llm_effort_s0, args.stage0_max_sentences)
-                raw0=""; parsed0=None
-                temp0=_effort_temperature(args.llm_effort_s0)
-                gen0={"prompt":prompt0,"temperature":temp0,"max_tokens":4048,"top_p":0.35,"repeat_penalty":1.05,"seed":101+b*42}
-                for att in range(args.retries):
-                    try:
-                        resp0=llm.create_completion(**gen0)
-                        raw0=resp0["choices"][0].get("text","")
-                        parsed0=parse_llm_response(raw0, encoding, effort=args.llm_effort_s0, debug_dir=args.debug_dir, prefer="non_neutral")
-                        break
-                    except Exception as ee:
-                        print(f"[Stage0 batch {b}] attempt {att+1} failed: {ee}", file=sys.stderr)
-                        time.sleep(0.3)
-                _maybe_dump(args.debug_dir,f"stage0_batch_{b}.raw.txt",raw0)
-                if parsed0: _maybe_dump(args.debug_dir,f"stage0_batch_{b}.parsed.json",parsed0)
-
-                nn_list=[]
+                yield b, batch, {"prompt":prompt0,"temperature":temp0,"max_tokens":4048,"top_p":0.35,"repeat_penalty":1.05,"seed":101+b*42}
+        run0=lambda job: _complete_with_retries(llm0, job[2], args.retries, f"Stage0 batch {job[0]}",
+                                                encoding, args.llm_effort_s0, args.debug_dir, "non_neutral")
+        with tqdm(total=len(scenes), desc="Stage 0", mininterval=1.0, miniters=1) as pbar0:
+            for (b, batch, _gen), (raw0, parsed0) in _prefetched(_stage0_jobs(), run0, gen_pool):
+                _dump(f"stage0_batch_{b}.raw.txt",raw0)
+                if parsed0: _dump(f"stage0_batch_{b}.parsed.json",parsed0)
+
+                nn_batch=None
                 if isinstance(parsed0, dict) and isinstance(parsed0.get("non_neutral"), list):
-                    nn_list=[int(x) for x in parsed0["non_neutral"] if isinstance(x,int)]
-                if nn_list:
-                    nn_set.update(nn_list)
+                    try:
+                        nn_batch={int(x) for x in parsed0["non_neutral"]}
+                    except (TypeError, ValueError):
+                        nn_batch=None
+                if nn_batch:
+                    nn_set|=nn_batch
                 else:
-                    # fail-safe: включаем весь батч
+                    # fail-safe (пусто или мусор в ответе): включаем весь батч
                     nn_set.update(sc["scene_index"] for sc in batch)
                 pbar0.update(len(batch))
-        selected_scene_indices=nn_set
+        selected_scene_indices=frozenset(nn_set)
+        if small_s0:
+            llm0.close()
+            llm=_build_llm(llm_cfg, llm_ctx)
+            _attach_kv_cache(llm, args.kv_cache_mb)
 
     def _scenes_for_stage1(all_scenes: List[Dict])->List[Dict]:
         if selected_scene_indices is None:
@@ -683,24 +1035,26 @@ def main():
     scenes_s1=_scenes_for_stage1(scenes)
 
     # Stage 1
-    with tqdm(total=len(scenes_s1), desc="Stage 1") as pbar1:
+    # в Stage 1 фрагменты только дописываются, поэтому parents_guide собирается инкрементально;
+    # Stage 2 меняет метки и удаляет фрагменты — там отчёт пересобирается целиком
+    s1_guide=GuideAccumulator(n_scenes)
+    temp1=_effort_temperature(args.llm_effort_s1)
+    def _stage1_jobs():
         for b in range(0,len(scenes_s1), args.batch_size):
             batch=scenes_s1[b:b+args.batch_size]
             prompt,_=build_stage1_conversation(batch, encoding, args.llm_effort_s1)
-            raw=""; parsed=None
-            temp=_effort_temperature(args.llm_effort_s1)
-            gen={"prompt":prompt,"temperature":temp,"max_tokens":4096,"top_p":0.3,"repeat_penalty":1.05,"seed":1111+b*42}
-            for att in range(args.retries):
-                try:
-                    resp=llm.create_completion(**gen)
-                    raw=resp["choices"][0].get("text","")
-                    parsed=parse_llm_response(raw, encoding, effort=args.llm_effort_s1, debug_dir=args.debug_dir, prefer="scene_results")
-                    break
-                except Exception as ee:
-                    print(f"[Stage1 batch {b}] attempt {att+1} failed: {ee}", file=sys.stderr)
-                    time.sleep(0.3)
-            _maybe_dump(args.debug_dir,f"stage1_batch_{b}.raw.txt",raw)
-            if parsed: _maybe_dump(args.debug_dir,f"stage1_batch_{b}.parsed.json",parsed)
+            yield b, batch, {"prompt":prompt,"temperature":temp1,"top_p":0.3,"repeat_penalty":1.05,"seed":1111+b*42}
+    def run1(job):
+        # генератор jobs работает в основном потоке, пока gen_pool декодирует: всё, что трогает модель
+        # (токенизация промпта для лимита), выполняется здесь, в потоке генерации
+        b, batch, gen=job
+        gen=dict(gen, max_tokens=min(STAGE1_OUT_TOKENS_PER_SCENE*len(batch), llm_ctx-_prompt_len(llm, gen["prompt"])-CTX_MARGIN))
+        return _complete_with_retries(llm, gen, args.retries, f"Stage1 batch {b}",
+                                      encoding, args.llm_effort_s1, args.debug_dir, "scene_results")
+    with tqdm(total=len(scenes_s1), desc="Stage 1", mininterval=1.0, miniters=1) as pbar1:
+        for (b, batch, _gen), (raw, parsed) in _prefetched(_stage1_jobs(), run1, gen_pool):
+            _dump(f"stage1_batch_{b}.raw.txt",raw)
+            if parsed: _dump(f"stage1_batch_{b}.parsed.json",parsed)
 
             scene_results=[]
             if isinstance(parsed,dict) and isinstance(parsed.get("scene_results"),list):
@@ -711,11 +1065,12 @@ def main():
                 pbar1.update(len(batch)); continue
 
             converted=[]
+            batch_by_id={s["scene_index"]: s for s in batch}
             for sr in scene_results:
                 if not isinstance(sr,dict): continue
                 sc_id=sr.get("scID")
                 if sc_id is None: continue
-                orig=next((s for s in batch if s["scene_index"]==sc_id), None)
+                orig=batch_by_id.get(sc_id)
                 if not orig: continue
                 snts=sr.get("snt",[])
                 packed=[]
@@ -736,89 +1091,90 @@ def main():
                     packed[0]["violations"]=[{"label":"MILD_CONFLICT","conf":60}]
                 if packed:
                     converted.append({"scene_index":sc_id,"sentences":packed})
-            new_frags=build_problem_fragments_from_compact(converted, scenes)
+            new_frags=build_problem_fragments_from_compact(converted, scenes, scenes_by_id)
+            # старые фрагменты уже финализированы, повторный проход по ним ничего не меняет
+            finalize_evidence_fields(new_frags)
             problem_fragments.extend(new_frags)
-
-            finalize_evidence_fields(problem_fragments)
-            report=assemble_report(os.path.basename(args.input), len(scenes), problem_fragments, time.time()-start)
-            with open(args.output,"w",encoding="utf-8") as f:
-                json.dump(report,f,ensure_ascii=False,indent=2)
+            _checkpoint(guide_acc=s1_guide)
             pbar1.update(len(batch))
+    _checkpoint(force=True, guide_acc=s1_guide)
 
     # Stage 2
+    sent_lists={sc_id: sc.get("sentences",[]) for sc_id,sc in scenes_by_id.items()}
     queries=[]; seen=set()
     for pf in problem_fragments:
         key=(pf["scene_index"], pf["sentence_index"])
         if key in seen: continue
         seen.add(key)
-        pt=""; nt=""
-        try:
-            sents=scenes[pf["scene_index"]].get("sentences",[])
-            if pf["sentence_index"]-1>=0: pt=sents[pf["sentence_index"]-1].get("text","")
-            if pf["sentence_index"]+1<len(sents): nt=sents[pf["sentence_index"]+1].get("text","")
-        except Exception:
-            pass
-        queries.append({"scID":pf["scene_index"],"id":pf["sentence_index"],"pt":pt,"t":pf["text"],"nt":nt,"vlc":pf["labels"]})
-
-    with tqdm(total=len(queries), desc="Stage 2") as pbar2:
-        for q in range(0,len(queries), 3):
-            q_batch=queries[q:q+3]
+        sl=sent_lists.get(key[0], ()); i=key[1]
+        pt=sl[i-1].get("text","") if 0<i<=len(sl) else ""
+        nt=sl[i+1].get("text","") if 0<=i+1<len(sl) else ""
+        queries.append({"scID":key[0],"id":i,"pt":pt,"t":pf["text"],"nt":nt,"vlc":pf["labels"]})
+
+    # батчи набираются по токенам: вход запроса + ожидаемый ответ на него, пока влезает в бюджет контекста
+    s2_base=_prompt_len(llm, build_stage2_conversation([], encoding, args.llm_effort_s2)[0])
+    s2_budget=(args.stage2_token_budget or llm_ctx-CTX_MARGIN) - s2_base
+    s2_in=[len(llm.tokenize(_json_bytes(qq), add_bos=False)) for qq in queries]
+    s2_costs=[t+args.stage2_max_tokens_per_query for t in s2_in]
+
+    temp2=_effort_temperature(args.llm_effort_s2)
+    def _stage2_jobs():
+        for q, q_batch in _pack_by_token_budget(queries, s2_costs, s2_budget):
             prompt2,_=build_stage2_conversation(q_batch, encoding, args.llm_effort_s2)
-            raw2=""; parsed2=None
-            temp2=_effort_temperature(args.llm_effort_s2)
-            gen2={"prompt":prompt2,"temperature":temp2,"max_tokens":40096,"top_p":0.3,"repeat_penalty":1.05,"seed":2222+q*42}
-            for att in range(args.retries):
-                try:
-                    resp2=llm.create_completion(**gen2)
-                    raw2=resp2["choices"][0].get("text","")
-                    parsed2=parse_llm_response(raw2, encoding, effort=args.llm_effort_s2, debug_dir=args.debug_dir, prefer="ans")
-                    break
-                except Exception as ee:
-                    print(f"[Stage2 batch {q}] attempt {att+1} failed: {ee}", file=sys.stderr)
-                    time.sleep(0.3)
-            _maybe_dump(args.debug_dir,f"stage2_batch_{q}.raw.txt",raw2)
-            if parsed2: _maybe_dump(args.debug_dir,f"stage2_batch_{q}.parsed.json",parsed2)
+            # лимит генерации пропорционален числу запросов и не выходит за контекст (вход уже оценён при упаковке)
+            max_tokens2=min(args.stage2_max_tokens_per_query*len(q_batch),
+                            llm_ctx-s2_base-sum(s2_in[q:q+len(q_batch)])-CTX_MARGIN)
+            yield q, q_batch, {"prompt":prompt2,"temperature":temp2,"max_tokens":max_tokens2,"top_p":0.3,"repeat_penalty":1.05,"seed":2222+q*42}
+    # в кеше лежит только raw-ответ: parsed мутируется дальше по пайплайну, поэтому при попадании парсим заново
+    s2_cache_path=os.path.join(args.debug_dir,"stage2_cache.json") if args.debug_dir and args.stage2_cache else None
+    s2_cache=_load_prompt_cache(s2_cache_path)
+    s2_model_id=llm_cfg.get("model_path") or (llm_cfg.get("repo_id"), llm_cfg.get("filename"))
+    def run2(job):
+        key=_prompt_key(job[2], s2_model_id)
+        raw2=s2_cache.get(key)
+        if raw2 is not None:
+            try:
+                return raw2, parse_llm_response(raw2, encoding, effort=args.llm_effort_s2, debug_dir=args.debug_dir, prefer="ans")
+            except ValueError:
+                pass
+        raw2, parsed2=_complete_with_retries(llm, job[2], args.retries, f"Stage2 batch {job[0]}",
+                                             encoding, args.llm_effort_s2, args.debug_dir, "ans")
+        if s2_cache_path and parsed2 is not None:
+            s2_cache[key]=raw2
+        return raw2, parsed2
+    with tqdm(total=len(queries), desc="Stage 2", mininterval=1.0, miniters=1) as pbar2:
+        for (q, q_batch, _gen), (raw2, parsed2) in _prefetched(_stage2_jobs(), run2, gen_pool):
+            _dump(f"stage2_batch_{q}.raw.txt",raw2)
+            if parsed2: _dump(f"stage2_batch_{q}.parsed.json",parsed2)
 
             ans_full=ensure_stage2_backfill(q_batch, parsed2)
             problem_fragments=apply_stage2(ans_full, problem_fragments, args.debug_dir)
             finalize_evidence_fields(problem_fragments)
-            report=assemble_report(os.path.basename(args.input), len(scenes), problem_fragments, time.time()-start)
-            with open(args.output,"w",encoding="utf-8") as f:
-                json.dump(report,f,ensure_ascii=False,indent=2)
+            _checkpoint()
             pbar2.update(len(q_batch))
+    _checkpoint(force=True)
+    _save_prompt_cache(s2_cache_path, s2_cache)
 
     # Stage 3
 
     packed_violated=pack_violated_sentences_with_context(problem_fragments, scenes)
     prompt3,_=build_stage3_conversation(law, packed_violated, encoding, args.llm_effort_s3)
-    raw3=""; parsed3=None
     temp3=_effort_temperature(args.llm_effort_s3)
-    for att in range(args.retries):
-        gen3 = {"prompt": prompt3, "temperature": 0, "max_tokens": 30000, "top_p": 1, "repeat_penalty": 1.05,
-                "seed": 420 + 42 * b}
+    # n_ctx для Stage 3 известен заранее: промпт + бюджет генерации; если общей модели не хватает,
+    # она пересоздаётся ровно один раз
+    s3_max_tokens=30000
+    s3_ctx=_round_up(_prompt_len(llm, prompt3) + s3_max_tokens + CTX_MARGIN, 1024)
+    if s3_ctx>llm_ctx:
         llm.close()
-        try:
-            if args.model_path:
-                llm = Llama(model_path=args.model_path, n_ctx=30000 + att * 7000, n_gpu_layers=args.n_gpu_layers, verbose=False)
-            else:
-                if hasattr(Llama, "from_pretrained"):
-                    llm = Llama.from_pretrained(repo_id=args.repo_id, filename=args.filename,
-                                                n_ctx=30000 + att * 7000, n_gpu_layers=args.n_gpu_layers, verbose=False)
-                else:
-                    llm = Llama(model_path=args.filename, n_ctx=30000 + att * 7000, n_gpu_layers=args.n_gpu_layers, verbose=False)
-        except Exception as e:
-            print("Model init failed:", e, file=sys.stderr)
-            raise
-        try:
-            resp3=llm.create_completion(**gen3)
-            raw3=resp3["choices"][0].get("text","")
-            parsed3=parse_llm_response(raw3, encoding, effort=args.llm_effort_s3, debug_dir=args.debug_dir, prefer="final_rating")
-            break
-        except Exception as ee:
-            print(f"[Stage3] attempt {att+1} failed: {ee}", file=sys.stderr)
-            time.sleep(0.3)
-    _maybe_dump(args.debug_dir,"stage3.raw.txt",raw3)
-    if parsed3: _maybe_dump(args.debug_dir,"stage3.parsed.json",parsed3)
+        llm_ctx=s3_ctx
+        llm=_build_llm(llm_cfg, llm_ctx)
+    gen_pool.shutdown(wait=True)
+    gen3 = {"prompt": prompt3, "temperature": 0, "max_tokens": s3_max_tokens, "top_p": 1, "repeat_penalty": 1.05,
+            "seed": 420 + 42 * b}
+    raw3, parsed3 = _complete_with_retries(llm, gen3, args.retries, "Stage3",
+                                           encoding, args.llm_effort_s3, args.debug_dir, "final_rating", stream=True)
+    _dump("stage3.raw.txt",raw3)
+    if parsed3: _dump("stage3.parsed.json",parsed3)
 
     model_final_rating=None
     model_explanation=None
@@ -830,7 +1186,7 @@ def main():
         if isinstance(exp,str) and exp.strip():
             model_explanation=exp.strip()
 
-    report=assemble_report(os.path.basename(args.input), len(scenes), problem_fragments,
+    report=assemble_report(doc_name, n_scenes, problem_fragments,
                            time.time()-start,
                            final_rating_override=None,
                            model_explanation=model_explanation,
@@ -839,8 +1195,9 @@ def main():
     if parsed3 and isinstance(model_final_rating, str) and model_final_rating.strip():
         report["final_rating"] = model_final_rating.strip()
 
-    with open(args.output,"w",encoding="utf-8") as f:
-        json.dump(report,f,ensure_ascii=False,indent=2)
+    io_pool.shutdown(wait=True)
+    if ckpt_fut is not None: ckpt_fut.result()
+    _dump_report(args.output, report, pretty=True)
     print(f"Done. Final rating: {report['final_rating']} (model raw: {report.get('model_final_rating','n/a')}) Saved: {args.output}")
 
 if __name__=="__main__":
@@ -2,10 +2,16 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 import argparse
+import hashlib
 import json
 import os
+import re
 import sys
 import time
+import threading
+from concurrent.futures import Future
+from functools import lru_cache
+from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple
 
 # llama_cpp (опционально)
@@ -15,6 +21,11 @@ try:
 except Exception:
     _HAS_LLAMA = False
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Harmony (опционально, если используется у вас в окружении)
 try:
     from openai_harmony import (
@@ -41,6 +52,9 @@ from constants import (
     CONDEMNATION_TOKENS, FAMILY_TOKENS, COMEDY_TOKENS, GRAPHIC_TOKENS, AROUSAL_TOKENS
 )
 
+_ORDERED_RATINGS_SET = frozenset(ORDERED_RATINGS)
+_RATING_RANK = {r: i for i, r in enumerate(ORDERED_RATINGS)}
+
 # ---------------- Effort helpers (как в пайплайне) ----------------
 def _effort_to_reasoning(effort: str):
     e=(effort or "low").lower()
@@ -52,35 +66,88 @@ def _effort_temperature(effort: str)->float:
     return 0.15 if e=="high" else (0.08 if e=="medium" else 0.01)
 
 # ---------------- Вспомогательные утилиты ----------------
+# orjson (если установлен) в разы быстрее json; без него — тот же формат через stdlib
+def _json_loads(raw: Any) -> Any:
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+def _prompt_json(obj: Any) -> str:
+    # текст промпта должен совпадать с pipeline.py байт в байт: только stdlib json с разделителями
+    # по умолчанию (", " и ": "), которых orjson не умеет
+    return json.dumps(obj, ensure_ascii=False)
+
+def _write_json(path: str, obj: Any) -> None:
+    # orjson отдаёт готовые UTF-8 байты — пишем их одним write без промежуточной str;
+    # stdlib json сериализует прямо в буферизованный файл, не собирая всю строку в памяти
+    if orjson is not None:
+        data = orjson.dumps(obj, option=orjson.OPT_INDENT_2|orjson.OPT_NON_STR_KEYS)
+        with open(path, "wb") as f:
+            f.write(data)
+    else:
+        with open(path, "w", encoding="utf-8", buffering=1<<20) as f:
+            json.dump(obj, f, ensure_ascii=False, indent=2)
+
+_DUMPED_DIRS: set = set()  # каталоги, уже созданные в этом процессе — makedirs вызывается один раз
+
 def _maybe_dump(debug_dir: Optional[str], filename: str, content: Any) -> None:
     if not debug_dir: return
     try:
-        os.makedirs(debug_dir, exist_ok=True)
-        with open(os.path.join(debug_dir, filename), "w", encoding="utf-8") as f:
-            if isinstance(content, (dict, list)):
-                json.dump(content, f, ensure_ascii=False, indent=2)
-            else:
+        if debug_dir not in _DUMPED_DIRS:
+            os.makedirs(debug_dir, exist_ok=True)
+            _DUMPED_DIRS.add(debug_dir)
+        path = os.path.join(debug_dir, filename)
+        if isinstance(content, (dict, list)):
+            _write_json(path, content)
+        else:
+            with open(path, "w", encoding="utf-8") as f:
                 f.write(str(content))
     except Exception:
         pass
 
+# Наборы меток и тексты фрагментов сильно повторяются — результаты кешируются (кеши сбрасываются в main)
+_LABEL_TO_GROUPS: Dict[str, frozenset] = {}
+for _g, _labs in THEMATIC_GROUPS.items():
+    for _l in _labs:
+        _LABEL_TO_GROUPS.setdefault(_l, set()).add(_g)
+_LABEL_TO_GROUPS = {l: frozenset(gs) for l, gs in _LABEL_TO_GROUPS.items()}
+
+@lru_cache(maxsize=2048)
+def _groups_for_label_set(labels: frozenset)->Tuple[str,...]:
+    return tuple(sorted({g for l in labels for g in _LABEL_TO_GROUPS.get(l, ())}))
+
 def _groups_for_labels(labels: List[str])->List[str]:
-    groups=[]
-    for g,labs in THEMATIC_GROUPS.items():
-        if any(l in labs for l in labels):
-            groups.append(g)
-    return sorted(set(groups))
+    return list(_groups_for_label_set(frozenset(labels)))
 
 # ---------------- Контекст и смягчающие факторы ----------------
-def detect_softeners(text_block: str)->dict:
-    t=text_block.lower()
+# Каждый набор токенов — одна альтернация: поиск идёт одним проходом regex-движка по тексту,
+# а не отдельным `tok in t` на каждый токен
+def _token_alt(tokens) -> re.Pattern:
+    return re.compile("|".join(re.escape(tok) for tok in sorted(tokens, key=len, reverse=True)))
+
+_CONDEMNATION_RE = _token_alt(CONDEMNATION_TOKENS)
+_FAMILY_RE = _token_alt(FAMILY_TOKENS)
+_COMEDY_RE = _token_alt(COMEDY_TOKENS)
+_DETAIL_RE = _token_alt(GRAPHIC_TOKENS | AROUSAL_TOKENS)
+
+@lru_cache(maxsize=4096)
+def _softener_flags(t: str)->Tuple[bool,bool,bool,bool]:
+    return (_CONDEMNATION_RE.search(t) is not None,
+            _FAMILY_RE.search(t) is not None,
+            _COMEDY_RE.search(t) is not None,
+            _DETAIL_RE.search(t) is None)
+
+def detect_softeners(text_block_lower: str)->dict:
+    # текст приходит уже в нижнем регистре — его же используем как ключ кэша
+    condemnation, family, comedy, low_detail = _softener_flags(text_block_lower)
     return {
-        "condemnation": any(tok in t for tok in CONDEMNATION_TOKENS),
-        "family_context": any(tok in t for tok in FAMILY_TOKENS),
-        "comedy": any(tok in t for tok in COMEDY_TOKENS),
-        "low_detail": not any(tok in t for tok in (GRAPHIC_TOKENS | AROUSAL_TOKENS))
+        "condemnation": condemnation,
+        "family_context": family,
+        "comedy": comedy,
+        "low_detail": low_detail
     }
 
+def _intern(x: Any) -> Any:
+    return sys.intern(x) if type(x) is str else x
+
 def _pack_with_optional_context(problem_fragments: List[Dict[str,Any]],
                                 scenes_index: Optional[Dict[int, Dict[str,Any]]]) -> List[Dict[str,Any]]:
     """
@@ -88,87 +155,117 @@ def _pack_with_optional_context(problem_fragments: List[Dict[str,Any]],
     Если сцен нет — отправляем без prev/next (LLM промпт допускает отсутствие контекста).
     """
     out=[]
+    append = out.append
+    detect = detect_softeners
+    groups_for = _groups_for_labels
+    scenes_get = scenes_index.get if scenes_index is not None else None
+    # метки и severity повторяются во всех фрагментах — интернируем, чтобы держать по одному объекту
+    intern = _intern
     for pf in problem_fragments:
         sc_idx = pf.get("scene_index")
         sent_idx = pf.get("sentence_index")
         text = pf.get("text","")
         labels = pf.get("labels",[]) or []
+        if isinstance(labels, list):
+            labels = [intern(l) for l in labels]
         ev_src = pf.get("evidence_spans",{}) or {}
         prev_list: List[str] = []
         next_list: List[str] = []
-        if scenes_index is not None and isinstance(sc_idx,int) and isinstance(sent_idx,int):
-            sc = scenes_index.get(sc_idx)
-            if sc and isinstance(sc.get("sentences"), list):
-                sents = sc["sentences"]
-                if sent_idx-1 >= 0 and sent_idx-1 < len(sents):
+        if scenes_get is not None and isinstance(sc_idx,int) and isinstance(sent_idx,int):
+            sc = scenes_get(sc_idx)
+            sents = sc.get("sentences") if sc else None
+            if isinstance(sents, list):
+                if 0 <= sent_idx-1 < len(sents):
                     prev_list.append(sents[sent_idx-1].get("text",""))
                 if sent_idx+1 < len(sents):
                     next_list.append(sents[sent_idx+1].get("text",""))
-        full_text_for_soft = " ".join(prev_list + [text] + next_list)
-        soft = detect_softeners(full_text_for_soft)
-        out.append({
+        # prev/next — не больше одного элемента: контекст склеивается без промежуточных списков
+        soft_text = text
+        if prev_list: soft_text = f"{prev_list[0]} {soft_text}"
+        if next_list: soft_text = f"{soft_text} {next_list[0]}"
+        ev = {}
+        for lab in labels:
+            e = ev_src.get(lab) or {}
+            ev[lab] = {"sev": intern(e.get("severity","")), "scr": e.get("score")}
+        append({
             "scene_index": sc_idx,
             "sentence_index": sent_idx,
             "text": text,
             "labels": labels,
-            "groups": _groups_for_labels(labels),
-            "severity_local": pf.get("severity_local","None"),
-            "ev": {lab:{
-                "sev": ev_src.get(lab,{}).get("severity",""),
-                "scr": ev_src.get(lab,{}).get("score")
-            } for lab in labels},
+            "groups": groups_for(labels),
+            "severity_local": intern(pf.get("severity_local","None")),
+            "ev": ev,
             "context_prev": prev_list,
             "context_next": next_list,
             "scene_heading": pf.get("scene_heading"),
-            "softeners": soft
+            "softeners": detect(soft_text.lower())
         })
     return out
 
 # ---------------- Построение промпта Stage 3 (как в пайплайне) ----------------
+_LAW_JSON_CACHE: Dict[int, Tuple[Any, str]] = {}
+
+@lru_cache(maxsize=None)
+def _system_message(effort: str):
+    # системное сообщение зависит только от effort — собирается один раз, а не на каждый промпт
+    sysc=SystemContent.new().with_reasoning_effort(_effort_to_reasoning(effort)).with_required_channels(["final"])
+    return Message.from_role_and_content(Role.SYSTEM, sysc)
+
+def _law_json(law_rules_obj: Any) -> str:
+    # ключ — id объекта; сам объект хранится рядом, чтобы id не переиспользовался
+    hit = _LAW_JSON_CACHE.get(id(law_rules_obj))
+    if hit is None or hit[0] is not law_rules_obj:
+        hit = (law_rules_obj, _prompt_json(law_rules_obj))
+        _LAW_JSON_CACHE[id(law_rules_obj)] = hit
+    return hit[1]
+
+_STAGE3_INSTRUCTION = (
+    "You are an expert on the Federal Law of the Russian Federation No. 436-FZ. Your task is to assign "
+    " THE LEAST acceptable age rating (0+, 6+, 12+, 16+, 18+). "
+    "Return ONLY JSON: {\"final_rating\":\"0+|6+|12+|16+|18+\",\"explanation\":string}.\n\n"
+
+    "Key decision-making rules (strictly):\n"
+    "1) Start from 0+. Raise the rating ONLY if there is an explicit, "
+    "unavoidable content that complies with the prohibitions/restrictions of the law.\n"
+    "2) **18+** — only if there is at least ONE of: \n"
+    " - explicit detailed sexual content (anatomical/medical/erotic/arousing, with details),\n"
+    " - sexual violence with details/coercion,\n"
+    " - detailed instructions on committing a serious crime or suicide/self-harm,\n"
+    " - extremist/terrorist propaganda or materials, definitely inciting to a crime.\n"
+    " If THERE are NO such criteria, do not raise it to 18+ even when mentioning the words \"kill\", \"murder\", etc.\n\n"
+    "3) Interpretation of important labels:\n"
+    " - MURDER_HOMICIDE (mention of murder) — **not** automatically 18+. If this is a retelling/rumor without a detailed stage demonstration or without praise, consider it Moderate/12-16+. Only an explicit image, encouragement, or instruction is above.\n"
+    " - DANGEROUS_IMITABLE_ACTS — consider it serious ONLY if the text contains specific step-by-step actions/tools/precise parameters that are easy to repeat. General descriptions of risk/danger — do not raise to 18+; more often 12+ or 16+ according to the context.\n"
+    " - WEAPONS_USAGE / VIOLENCE_NON_GRAPHIC — usually 12+; raise to 16+ if there are many episodes, there is a demonstration of damage /consequences, or there is glorification/instruction.\n"
+    " - DRUGS_USE_DEPICTION — only in case of explicit demonstration of use/overdose/preparation details — 16+-18+ . A simple mention or description of past events is not 18+.\n"
+    " - PROFANITY_OBSCENE — limit to 16+ only if there is widespread rude language and it is key to the scene; a single obscene insertion usually does not raise above 12+.\n\n"
+    "4) Mitigating factors (if present, they lower the rating):\n"
+    " - explicit condemnation/showing of negative consequences/consequences for characters (condemnation),\n"
+    " - family/protective context, medical or legal context (family_context),\n"
+    " - comic/parodic tone without realistic instructions (comedy),\n"
+    " - low detail (low_detail) — lack of anatomical/technical details.\n"
+    " If there are mitigating factors, lower the rating by one notch if possible.\n\n"
+    "5) Practical logic: Consider the difference between a 'phrase' and an 'action.'"
+    "Explicit mention of past crimes/threats is not the same as step—by-step execution or instruction.\n\n"
+    "6) Provide a CLEAR list of labels/ fragments in the explanation, "
+    " which, in your opinion, force the outcome, and what mitigating factors were applied. "
+    "If you upgraded to 18+, specify the specific reason for item 2.\n\n"
+    "Input: JSON with categories of the law and a list of infringing sentences with context. "
+    "Rely on the law, but the goal is TO ASSIGN THE LOWEST ACCEPTABLE rating.\n"
+)
+# инструкция неизменна — префикс промпта собирается один раз при импорте
+_STAGE3_PREFIX = _STAGE3_INSTRUCTION + "\nInput:"
+
 def build_stage3_conversation(law_rules_obj: Dict[str,Any],
                               violated_sentences: List[Dict[str,Any]],
                               encoding,
                               llm_effort: str="medium")->tuple[str,List[str]]:
-    instruction = (
-        "You are an expert on the Federal Law of the Russian Federation No. 436-FZ. Your task is to assign "
-        " THE LEAST acceptable age rating (0+, 6+, 12+, 16+, 18+). "
-        "Return ONLY JSON: {\"final_rating\":\"0+|6+|12+|16+|18+\",\"explanation\":string}.\n\n"
-
-        "Key decision-making rules (strictly):\n"
-        "1) Start from 0+. Raise the rating ONLY if there is an explicit, "
-        "unavoidable content that complies with the prohibitions/restrictions of the law.\n"
-        "2) **18+** — only if there is at least ONE of: \n"
-        " - explicit detailed sexual content (anatomical/medical/erotic/arousing, with details),\n"
-        " - sexual violence with details/coercion,\n"
-        " - detailed instructions on committing a serious crime or suicide/self-harm,\n"
-        " - extremist/terrorist propaganda or materials, definitely inciting to a crime.\n"
-        " If THERE are NO such criteria, do not raise it to 18+ even when mentioning the words \"kill\", \"murder\", etc.\n\n"
-        "3) Interpretation of important labels:\n"
-        " - MURDER_HOMICIDE (mention of murder) — **not** automatically 18+. If this is a retelling/rumor without a detailed stage demonstration or without praise, consider it Moderate/12-16+. Only an explicit image, encouragement, or instruction is above.\n"
-        " - DANGEROUS_IMITABLE_ACTS — consider it serious ONLY if the text contains specific step-by-step actions/tools/precise parameters that are easy to repeat. General descriptions of risk/danger — do not raise to 18+; more often 12+ or 16+ according to the context.\n"
-        " - WEAPONS_USAGE / VIOLENCE_NON_GRAPHIC — usually 12+; raise to 16+ if there are many episodes, there is a demonstration of damage /consequences, or there is glorification/instruction.\n"
-        " - DRUGS_USE_DEPICTION — only in case of explicit demonstration of use/overdose/preparation details — 16+-18+ . A simple mention or description of past events is not 18+.\n"
-        " - PROFANITY_OBSCENE — limit to 16+ only if there is widespread rude language and it is key to the scene; a single obscene insertion usually does not raise above 12+.\n\n"
-        "4) Mitigating factors (if present, they lower the rating):\n"
-        " - explicit condemnation/showing of negative consequences/consequences for characters (condemnation),\n"
-        " - family/protective context, medical or legal context (family_context),\n"
-        " - comic/parodic tone without realistic instructions (comedy),\n"
-        " - low detail (low_detail) — lack of anatomical/technical details.\n"
-        " If there are mitigating factors, lower the rating by one notch if possible.\n\n"
-        "5) Practical logic: Consider the difference between a 'phrase' and an 'action.'"
-        "Explicit mention of past crimes/threats is not the same as step—by-step execution or instruction.\n\n"
-        "6) Provide a CLEAR list of labels/ fragments in the explanation, "
-        " which, in your opinion, force the outcome, and what mitigating factors were applied. "
-        "If you upgraded to 18+, specify the specific reason for item 2.\n\n"
-        "Input: JSON with categories of the law and a list of infringing sentences with context. "
-        "Rely on the law, but the goal is TO ASSIGN THE LOWEST ACCEPTABLE rating.\n"
-    )
-    payload={"law_categories":law_rules_obj,"violated_sentences":violated_sentences}
-    user_content=instruction+"\nInput:"+json.dumps(payload,ensure_ascii=False)
+    # {"law_categories":...,"violated_sentences":...} собирается из частей: закон сериализуется один раз за прогон
+    payload="".join(('{"law_categories": ', _law_json(law_rules_obj), ', "violated_sentences": ', _prompt_json(violated_sentences), '}'))
+    user_content=_STAGE3_PREFIX+payload
     if HARMONY_AVAILABLE and encoding:
-        sysc=SystemContent.new().with_reasoning_effort(_effort_to_reasoning(llm_effort)).with_required_channels(["final"])
         convo=Conversation.from_messages([
-            Message.from_role_and_content(Role.SYSTEM, sysc),
+            _system_message((llm_effort or "low").lower()),
             Message.from_role_and_content(Role.USER, user_content)
         ])
         tokens=encoding.render_conversation_for_completion(convo, Role.ASSISTANT)
@@ -184,7 +281,112 @@ def fallback_minimal(problem_fragments: List[Dict[str,Any]]) -> str:
     """
     return "6+" if problem_fragments else "0+"
 
+# ---------------- Вызов модели ----------------
+# Генерация детерминирована (temperature=0, фиксированный seed), поэтому ответ кешируется на диске
+# по хешу модели, промпта и параметров: повторный прогон на том же входе обходится без модели
+def _llm_cache_path(args, gen: Dict[str,Any]) -> Optional[str]:
+    cache_dir = args.cache_dir or (os.path.join(args.debug_dir, "llm_cache") if args.debug_dir else None)
+    if args.no_cache or not cache_dir:
+        return None
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((args.model_path or (args.repo_id, args.filename), sorted((k, v) for k, v in gen.items() if k != "prompt"))).encode("utf-8"))
+    h.update(gen["prompt"].encode("utf-8"))
+    return os.path.join(cache_dir, h.hexdigest() + ".txt")
+
+def _read_cached(path: Optional[str]) -> str:
+    if not path: return ""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return ""
+
+def _write_cached(path: Optional[str], raw: str) -> None:
+    if not path: return
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".partial"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(raw)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"[Stage3] cache write failed: {e}", file=sys.stderr)
+
+def _has_valid_rating(parsed: Optional[Dict[str,Any]]) -> bool:
+    fr = parsed.get("final_rating") if isinstance(parsed, dict) else None
+    return isinstance(fr, str) and fr.strip() in _ORDERED_RATINGS_SET
+
+def _parse_stage3(raw3: str, encoding, args) -> Optional[Dict[str,Any]]:
+    try:
+        return parse_llm_response(raw3, encoding, effort=args.llm_effort, debug_dir=args.debug_dir, prefer="final_rating")
+    except Exception as pe:
+        print(f"[Stage3] parse failed: {pe}", file=sys.stderr)
+        return None
+
+def _generate_stage3(get_llm, encoding, law_obj: Dict[str,Any], violated_sentences: List[Dict[str,Any]],
+                     args, suffix: str="") -> Optional[Dict[str,Any]]:
+    prompt3, _ = build_stage3_conversation(law_obj, violated_sentences, encoding, args.llm_effort)
+    gen3 = {
+        "prompt": prompt3,
+        "temperature": 0,
+        "max_tokens": 50000,
+        "top_p": 1,
+        "repeat_penalty": 1.05,
+        "seed": 420,
+    }
+    cache_path = _llm_cache_path(args, gen3)
+    raw3 = _read_cached(cache_path)
+    # в кеш пишутся только ответы с валидным final_rating; запись, которая не разбирается, считается промахом
+    parsed3 = _parse_stage3(raw3, encoding, args) if raw3 else None
+    if not _has_valid_rating(parsed3):
+        # модель нужна только при промахе кеша
+        llm = get_llm()
+        if llm is None:
+            return parsed3
+        raw3 = ""
+        for att in range(args.retries):
+            try:
+                resp3 = llm.create_completion(**gen3)
+                raw3 = resp3["choices"][0].get("text","")
+                break
+            except Exception as ee:
+                if att+1 == args.retries:
+                    print(f"[Stage3] LLM call failed: {ee}", file=sys.stderr)
+                else:
+                    time.sleep(0.25 * 2**att)
+        parsed3 = _parse_stage3(raw3, encoding, args) if raw3 else None
+        if _has_valid_rating(parsed3): _write_cached(cache_path, raw3)
+    _maybe_dump(args.debug_dir,f"stage3{suffix}.raw.txt",raw3)
+    if parsed3 is not None: _maybe_dump(args.debug_dir,f"stage3{suffix}.parsed.json", parsed3)
+    return parsed3
+
+def _merge_stage3_parts(parts: List[Dict[str,Any]]) -> Optional[Dict[str,Any]]:
+    # Итог по частям — самый строгий валидный рейтинг (вместе с его объяснением)
+    rated = [p for p in parts if isinstance(p.get("final_rating"), str) and p["final_rating"].strip() in _ORDERED_RATINGS_SET]
+    if not rated:
+        return parts[0] if parts else None
+    return max(rated, key=lambda p: _RATING_RANK[p["final_rating"].strip()])
+
 # ---------------- Основной поток Stage 3 ----------------
+def _start_llm_init(args) -> Future:
+    # Поток-демон: если ответ найдётся в кеше, процесс завершается, не дожидаясь загрузки модели
+    fut: Future = Future()
+    def run():
+        try:
+            fut.set_result(_init_llm(args))
+        except BaseException as e:
+            fut.set_exception(e)
+    threading.Thread(target=run, name="llm-init", daemon=True).start()
+    return fut
+
+def _init_llm(args) -> "Llama":
+    if args.model_path:
+        return Llama(model_path=args.model_path, n_ctx=args.n_ctx, n_gpu_layers=args.n_gpu_layers, verbose=False)
+    if hasattr(Llama, "from_pretrained"):
+        return Llama.from_pretrained(repo_id=args.repo_id, filename=args.filename,
+                                     n_ctx=args.n_ctx, n_gpu_layers=args.n_gpu_layers, verbose=False)
+    return Llama(model_path=args.filename, n_ctx=args.n_ctx, n_gpu_layers=args.n_gpu_layers, verbose=False)
+
 def main():
     ap = argparse.ArgumentParser(description="Stage 3 only — run exactly like pipeline Stage 3 (model rating preferred).")
     ap.add_argument("--input", default="test.json", help="JSON from stages 1+2 (must include problem_fragments)")
@@ -199,13 +401,26 @@ def main():
     ap.add_argument("--n-gpu-layers", type=int, default=-1)
     ap.add_argument("--llm-effort", choices=["low","medium","high"], default="high")
     ap.add_argument("--retries", type=int, default=3)
-    ap.add_argument("--debug-dir", default='debug')
+    ap.add_argument("--no-cache", default=False, action="store_true", help="Ignore and do not update the LLM response cache")
+    ap.add_argument("--chunk-fragments", type=int, default=0,
+                    help="Split violated sentences into prompts of at most N fragments and keep the highest rating (0 = one prompt)")
+    ap.add_argument("--debug-dir", default=None, help="Write debug dumps here (off by default)")
+    ap.add_argument("--debug", default=False, action="store_true", help="Write debug dumps to ./debug")
+    ap.add_argument("--cache-dir", default=None, help="LLM response cache dir (default: <debug-dir>/llm_cache; no cache without either)")
     args = ap.parse_args()
+    if args.debug and not args.debug_dir:
+        args.debug_dir = "debug"
 
     start = time.time()
+    _softener_flags.cache_clear()
+    _groups_for_label_set.cache_clear()
+
+    # Загрузка модели — самая долгая часть: идёт в фоне, пока читаются JSON и пакуются фрагменты
+    llm_future = None
+    if (not args.no_llm) and _HAS_LLAMA:
+        llm_future = _start_llm_init(args)
 
-    with open(args.input, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    data = _json_loads(Path(args.input).read_bytes())
     if not isinstance(data, dict):
         raise TypeError("Input must be JSON object containing 'problem_fragments'")
 
@@ -217,13 +432,14 @@ def main():
     document_name = data.get("document") or os.path.basename(args.input)
 
     # Опционально: если есть полные сцены — используем для контекста
-    scenes_by_index: Optional[Dict[int, Dict[str,Any]]] = None
-    if isinstance(data.get("scenes"), list):
-        scenes_by_index = {sc.get("scene_index"): sc for sc in data["scenes"] if isinstance(sc, dict) and "scene_index" in sc}
+    scenes = data.get("scenes")
+    scenes_by_index: Optional[Dict[int, Dict[str,Any]]] = (
+        {sc["scene_index"]: sc for sc in scenes if isinstance(sc, dict) and "scene_index" in sc}
+        if isinstance(scenes, list) else None
+    )
 
     # Загружаем закон
-    with open(args.law_file, "r", encoding="utf-8") as f:
-        law_obj = json.load(f)
+    law_obj = _json_loads(Path(args.law_file).read_bytes())
 
     # Формируем violated_sentences как в пайплайне (с контекстом, если можем)
     violated_sentences = _pack_with_optional_context(problem_fragments, scenes_by_index)
@@ -232,61 +448,40 @@ def main():
     model_final_rating: Optional[str] = None
     model_explanation: Optional[str] = None
 
-    raw3 = ""
     parsed3: Optional[Dict[str,Any]] = None
 
-    if not args.no_llm if False else not args.no_llm:  # safe guard in case of typo in flags
-        pass
-    # Корректная проверка:
-    if (not args.no_llm) and _HAS_LLAMA:
-        # Инициализируем модель
-        llm = None
-        try:
-            if args.model_path:
-                llm = Llama(model_path=args.model_path, n_ctx=args.n_ctx, n_gpu_layers=args.n_gpu_layers, verbose=False)
-            else:
-                if hasattr(Llama, "from_pretrained"):
-                    llm = Llama.from_pretrained(repo_id=args.repo_id, filename=args.filename,
-                                                n_ctx=args.n_ctx, n_gpu_layers=args.n_gpu_layers, verbose=False)
-                else:
-                    llm = Llama(model_path=args.filename, n_ctx=args.n_ctx, n_gpu_layers=args.n_gpu_layers, verbose=False)
-        except Exception as e:
-            print(f"[Stage3] LLM init failed: {e}", file=sys.stderr)
-
-        if llm is not None:
-            # Harmony (опционально)
-            encoding = load_harmony_encoding(HarmonyEncodingName.HARMONY_GPT_OSS) if HARMONY_AVAILABLE else None
-            prompt3, _ = build_stage3_conversation(law_obj, violated_sentences, encoding, args.llm_effort)
-            gen3 = {
-                "prompt": prompt3,
-                "temperature": 0,
-                "max_tokens": 50000,
-                "top_p": 1,
-                "repeat_penalty": 1.05,
-                "seed": 420,
-            }
-            for att in range(args.retries):
+    if llm_future is not None:
+        # Модель дожидаемся только при первом промахе кеша
+        llm_box: List[Any] = []
+        def get_llm():
+            if not llm_box:
                 try:
-                    resp3 = llm.create_completion(**gen3)
-                    raw3 = resp3["choices"][0].get("text","")
-                    break
-                except Exception as ee:
-                    if att+1 == args.retries:
-                        print(f"[Stage3] LLM call failed: {ee}", file=sys.stderr)
-                    time.sleep(0.25)
-            _maybe_dump(args.debug_dir,"stage3.raw.txt",raw3)
-
-            if raw3:
-                try:
-                    parsed3 = parse_llm_response(raw3, encoding, effort=args.llm_effort, debug_dir=args.debug_dir, prefer="final_rating")
-                    _maybe_dump(args.debug_dir,"stage3.parsed.json", parsed3)
-                except Exception as pe:
-                    print(f"[Stage3] parse failed: {pe}", file=sys.stderr)
+                    llm_box.append(llm_future.result())
+                except Exception as e:
+                    print(f"[Stage3] LLM init failed: {e}", file=sys.stderr)
+                    llm_box.append(None)
+            return llm_box[0]
+
+        # Harmony (опционально)
+        encoding = load_harmony_encoding(HarmonyEncodingName.HARMONY_GPT_OSS) if HARMONY_AVAILABLE else None
+        step = args.chunk_fragments
+        if step > 0 and len(violated_sentences) > step:
+            # Крупный вход — несколько промптов по step фрагментов. Общий префикс (инструкция + закон)
+            # llama.cpp берёт из KV-кеша предыдущего вызова, заново считается только хвост с фрагментами
+            parts = []
+            for k, i in enumerate(range(0, len(violated_sentences), step)):
+                part = _generate_stage3(get_llm, encoding, law_obj, violated_sentences[i:i+step], args, f".{k}")
+                if isinstance(part, dict):
+                    parts.append(part)
+            parsed3 = _merge_stage3_parts(parts)
+            _maybe_dump(args.debug_dir,"stage3.parsed.json", parsed3)
+        else:
+            parsed3 = _generate_stage3(get_llm, encoding, law_obj, violated_sentences, args)
 
     # Как в пайплайне: записываем рейтинг МОДЕЛИ, если он распарсился; иначе — фолбэк.
     if isinstance(parsed3, dict):
         fr = parsed3.get("final_rating")
-        if isinstance(fr, str) and fr.strip() in ORDERED_RATINGS:
+        if isinstance(fr, str) and fr.strip() in _ORDERED_RATINGS_SET:
             model_final_rating = fr.strip()
         exp = parsed3.get("explanation")
         if isinstance(exp, str) and exp.strip():
@@ -309,8 +504,7 @@ def main():
         "model_explanation": model_explanation,
         "processing_seconds": round(time.time()-start, 2)
     }
-    with open(args.output, "w", encoding="utf-8") as f:
-        json.dump(out, f, ensure_ascii=False, indent=2)
+    _write_json(args.output, out)
 
     print(f"Stage 3 done. Final rating: {out['final_rating']} (model: {out.get('model_final_rating') or 'n/a'}) Saved: {args.output}")
 
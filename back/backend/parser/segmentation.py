@@ -16,8 +16,18 @@ import re
 import unicodedata
 import importlib
 import collections
+import array
+import io
+import threading
 import zipfile
 import xml.etree.ElementTree as ET
+try:
+    from lxml import etree as LET  # libxml2-backed, much faster on large document.xml
+except Exception:
+    LET = None
+from concurrent.futures import Future
+from functools import lru_cache
+from itertools import chain
 from typing import List, Dict, Any, Optional, Tuple, Union, Iterable, DefaultDict
 
 # -------------------------
@@ -40,9 +50,14 @@ PdfReader = None
 Document = None
 Image = None
 _easyocr = None
+_imports_done = False
+_easyocr_future: Optional[Future] = None
+_easyocr_lock = threading.Lock()
 
 def _lazy_imports():
-    global _fitz, _pdfplumber, PdfReader, Document, Image, _easyocr
+    global _fitz, _pdfplumber, PdfReader, Document, Image, _easyocr, _imports_done
+    if _imports_done:
+        return
     try:
         _fitz = importlib.import_module("fitz")  # PyMuPDF
     except Exception:
@@ -73,11 +88,10 @@ def _lazy_imports():
         Image = _PILImage
     except Exception:
         Image = None
+    # set last: a concurrent caller must not see the flag before the modules are in place
+    _imports_done = True
 
-def _get_easyocr_reader():
-    global _easyocr
-    if _easyocr is not None:
-        return _easyocr
+def _build_easyocr_reader():
     try:
         easyocr = importlib.import_module("easyocr")
     except Exception as e:
@@ -87,25 +101,54 @@ def _get_easyocr_reader():
             "And ensure torch (CPU) is available, e.g.:\n"
             "  pip install torch --index-url https://download.pytorch.org/whl/cpu\n"
         ) from e
-    _easyocr = easyocr.Reader(["ru", "en"], gpu=False, verbose=False)
+    return easyocr.Reader(["ru", "en"], gpu=False, verbose=False)
+
+def _start_easyocr_preload() -> Future:
+    """
+    Build the EasyOCR reader (torch import + model load, several seconds) on a daemon thread.
+    Repeated calls share the same future.
+    """
+    global _easyocr_future
+    with _easyocr_lock:
+        if _easyocr_future is None:
+            fut: Future = Future()
+            def run():
+                try:
+                    fut.set_result(_build_easyocr_reader())
+                except BaseException as e:
+                    fut.set_exception(e)
+            threading.Thread(target=run, name="easyocr-init", daemon=True).start()
+            _easyocr_future = fut
+        return _easyocr_future
+
+def _get_easyocr_reader():
+    global _easyocr, _easyocr_future
+    if _easyocr is not None:
+        return _easyocr
+    try:
+        _easyocr = _start_easyocr_preload().result()
+    except Exception:
+        # let the next call retry instead of re-raising a stale failure
+        with _easyocr_lock:
+            _easyocr_future = None
+        raise
     return _easyocr
 
 # -------------------------
 # normalization + regexes
 # -------------------------
-SOFT_HYPHEN_RE = re.compile("\u00AD")
 WHITESPACES = ["\u00A0", "\u202F", "\u2007"]
 DASH_TRANSLATE = {ord("–"):"-", ord("—"):"-", ord("−"):"-", ord("-"):"-"}
+# soft hyphen, odd spaces, tabs and dashes in one str.translate; newlines are kept
+_NORM_TRANS = {**DASH_TRANSLATE, ord("\u00AD"): None, ord("\t"): " ", **{ord(ws): " " for ws in WHITESPACES}}
+SPACE_RUN_RE = re.compile(r" {2,}")
 
 def normalize_text(s: str) -> str:
     if not s:
         return ""
-    s = unicodedata.normalize("NFKC", s)
-    s = SOFT_HYPHEN_RE.sub("", s)
-    for ws in WHITESPACES:
-        s = s.replace(ws, " ")
-    s = s.translate(DASH_TRANSLATE)
-    s = re.sub(r"[ \t]+", " ", s)
+    s = unicodedata.normalize("NFKC", s).translate(_NORM_TRANS)
+    if "  " in s:
+        s = SPACE_RUN_RE.sub(" ", s)
     return s.strip()
 
 DASH = r"[–—-]"
@@ -152,24 +195,47 @@ COMMON_LOWER_START = re.compile(r'^(?:и|а|но|как|когда|если|по
 UPPER_COMMA_CONT_RE = re.compile(r'^[«"(\[]?[А-ЯЁ][а-яё]+,\s')
 TIME_PREFIX_RE = re.compile(r'^\(\s*\d{1,2}:\d{2}\s*\)\s*|^\d{1,2}:\d{2}\s*')
 DASH_END_RE = re.compile(rf"{DASH}\s*$")
-SLUG_HEAD_RE = re.compile(rf"^\s*(?:{SCN_NUM})(?:\s*\([^)]+\)\.)?\s*$", re.IGNORECASE)
+DASH_ENDINGS = ("–", "—", "-")
 IE_LINE_RE = re.compile(rf"^\s*{IE_TOK}\b", re.IGNORECASE)
+IE_STRIP_RE = re.compile(rf"^\s*{IE_TOK}\b\.?\s*", re.IGNORECASE)
+IE_ANYWHERE_RE = re.compile(rf"\b{IE_TOK}\b", re.IGNORECASE)
+SLASH_WS_RE = re.compile(r"\s*/\s*")
+SLUG_REST_KEYWORD_RE = re.compile(r'\b(INT|ИНТ|EXT|ЭКСТ|NAT|НАТ|ДЕНЬ|НОЧЬ|УТРО|ВЕЧЕР)\b')
+CLOSING_PUNCT = frozenset(".!?…:")
+MULTI_WS_RE = re.compile(r"\s{2,}")
+WORD_DASH_END_RE = re.compile(r'\w-\Z')
+# A slug can only start with a scene number, a suffix dash, a "(...)" note or an IE token.
+# İ/ı are included because re.IGNORECASE folds them onto I.
+_SLUG_FIRST_CHARS = frozenset("0123456789-(IiEeİıИиЭэНн")
+_SLUG_NUMBER_CHARS = frozenset("0123456789-(")
 
 # helpers for columns/pagination
 PAGE_NUM_RE = re.compile(r'^\s*страница\s*\d+\s*$', re.IGNORECASE)
+COLUMN_GAP_RE = re.compile(r'\s{3,}')
 FOOTER_HEADER_CLEAN_RE = re.compile(r'^(?:page|страница|серия|episode)\b.*$', re.IGNORECASE)
 
 # cast heuristics
 CAST_HEADER_LINE_REJECT_CHARS = re.compile(r"[0-9;:!?]")
 CAST_TOKEN_RE = re.compile(r"^[A-Za-zА-Яа-яЁё][A-Za-zА-Яа-яЁё\.\- ]*$")
+# [a-zа-яё] / [A-ZА-ЯЁ] as sets: presence checks become frozenset.isdisjoint (C loop, no regex)
+LOWER_LETTERS = frozenset("abcdefghijklmnopqrstuvwxyz" + "".join(map(chr, range(ord("а"), ord("я") + 1))) + "ё")
+UPPER_LETTERS = frozenset(c.upper() for c in LOWER_LETTERS)
+HAS_LETTER_RE = re.compile(r"[A-Za-zА-Яа-яЁё]")
+TITLE_NAME_RE = re.compile(r'^[A-ZА-ЯЁ][a-zа-яё\-]+(?:\s+[A-ZА-ЯЁ][a-zа-яё\-]+)?$')
+NAME_REST_RE = re.compile(r'^([A-ZА-ЯЁ][a-zа-яё\-]+(?:\s+[A-ZА-ЯЁ][a-zа-яё\-]+)?)\s+(.+)$')
+TITLE_CUE_RE = re.compile(r'^[A-ZА-ЯЁ][a-zа-яё]+(?:\s+[A-ZА-ЯЁ][a-zа-яё]+)?\:??$')
+VERTICAL_NAME_RE = re.compile(r'^[A-ZА-ЯЁ][A-ZА-ЯЁ\-\s\.]+$')
+VERTICAL_REJECT_RE = re.compile(r'[0-9;:!?]')
+VERTICAL_TITLE_REJECT_RE = re.compile(r'[0-9;:!?\.]')
+UPPER_LIST_RE = re.compile(r'[A-ZА-ЯЁ].*,.*[A-ZА-ЯЁ]')
 
 def looks_like_name(tok: str) -> bool:
     tok = (tok or "").strip()
     if not tok:
         return False
-    if tok.upper() == tok and re.search(r'[A-ZА-ЯЁ]', tok):
+    if tok.upper() == tok and not UPPER_LETTERS.isdisjoint(tok):
         return True
-    if re.match(r'^[A-ZА-ЯЁ][a-zа-яё\-]+(?:\s+[A-ZА-ЯЁ][a-zа-яё\-]+)?$', tok):
+    if TITLE_NAME_RE.match(tok):
         return True
     return False
 
@@ -230,7 +296,7 @@ def _extract_cast_header_and_action(text: str) -> Tuple[List[str], str]:
     for it in items:
         if len(it) > 40:
             return [], text
-        if not re.search(r"[A-Za-zА-Яа-яЁё]", it):
+        if not HAS_LETTER_RE.search(it):
             return [], text
         filtered.append("-".join(x.capitalize() for x in it.split("-")))
     if len(filtered) < 3:
@@ -243,6 +309,40 @@ def _extract_cast_header_and_action(text: str) -> Tuple[List[str], str]:
 # DOCX numbering-aware extraction
 # -------------------------
 W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+W_NSMAP = {"w": W_NS[1:-1]}
+# Clark-notation names, built once instead of per element
+_TAG_P = f"{W_NS}p"
+_TAG_T = f"{W_NS}t"
+_ATTR_VAL = f"{W_NS}val"
+_ATTR_ILVL = f"{W_NS}ilvl"
+_ATTR_NUMID = f"{W_NS}numId"
+_ATTR_ABSID = f"{W_NS}abstractNumId"
+
+def _xml_fromstring(xml: str):
+    if LET is not None:
+        return LET.fromstring(xml.encode("utf-8"))
+    return ET.fromstring(xml)
+
+def _compile_path(path: str):
+    """Compiled XPath under lxml; plain ElementPath findall with the same 'w:' prefix otherwise."""
+    if LET is not None:
+        return LET.XPath(path, namespaces=W_NSMAP)
+    return lambda elem: elem.findall(path, W_NSMAP)
+
+def _first(xp, elem):
+    found = xp(elem)
+    return found[0] if found else None
+
+_XP_NUM = _compile_path(".//w:num")
+_XP_ABSNUM = _compile_path(".//w:abstractNum")
+_XP_NUMID = _compile_path("w:numId")
+_XP_ABSNUMID = _compile_path("w:abstractNumId")
+_XP_LVL = _compile_path("w:lvl")
+_XP_LVLTEXT = _compile_path("w:lvlText")
+_XP_NUMFMT = _compile_path("w:numFmt")
+_XP_START = _compile_path("w:start")
+_XP_NUMPR = _compile_path("w:pPr/w:numPr")
+_XP_ILVL = _compile_path("w:ilvl")
 
 def _safe_find(elem: ET.Element, path: str) -> Optional[ET.Element]:
     return elem.find(path)
@@ -250,39 +350,67 @@ def _safe_find(elem: ET.Element, path: str) -> Optional[ET.Element]:
 def _safe_findall(elem: ET.Element, path: str) -> List[ET.Element]:
     return elem.findall(path)
 
+def _iter_paragraphs(doc_xml: bytes) -> Iterable[Any]:
+    """
+    Stream <w:p> elements of document.xml in document order, freeing each top-level
+    paragraph after use so only one paragraph subtree is held in memory at a time.
+    Paragraphs nested in text boxes are yielded right after their enclosing paragraph,
+    as a full-tree .//w:p search would.
+    """
+    if LET is not None:
+        events = LET.iterparse(io.BytesIO(doc_xml), events=("start", "end"), tag=_TAG_P)
+    else:
+        events = ET.iterparse(io.BytesIO(doc_xml), events=("start", "end"))
+    depth = 0
+    for event, el in events:
+        if el.tag != _TAG_P:
+            continue
+        if event == "start":
+            depth += 1
+            continue
+        depth -= 1
+        if depth:
+            continue
+        yield from el.iter(_TAG_P)
+        el.clear()
+        if LET is not None:
+            # drop already processed siblings (tables, cleared paragraphs) as well
+            while el.getprevious() is not None:
+                del el.getparent()[0]
+
 def _parse_numbering_xml(numbering_xml: str) -> Dict[str, Any]:
     """
     Parse numbering.xml and return:
       - numid_to_abstract: { numId -> abstractNumId }
       - abstract_levels: { abstractNumId -> { ilvl (int) -> { 'lvlText': str or None, 'numFmt': str or None, 'start': int } } }
     """
-    root = ET.fromstring(numbering_xml)
+    root = _xml_fromstring(numbering_xml)
     numid_to_abstract: Dict[str, str] = {}
     abstract_levels: Dict[str, Dict[int, Dict[str, Any]]] = {}
 
     # map numId -> abstractNumId
-    for num in root.findall(f".//{W_NS}num"):
-        nid = num.get(f"{{http://schemas.openxmlformats.org/wordprocessingml/2006/main}}numId")
+    for num in _XP_NUM(root):
+        nid = num.get(_ATTR_NUMID)
         if not nid:
             # try child w:numId/@w:val
-            nid_node = num.find(f"{W_NS}numId")
-            nid = nid_node.get(f"{{http://schemas.openxmlformats.org/wordprocessingml/2006/main}}val") if nid_node is not None else None
-        abs_elem = num.find(f"{W_NS}abstractNumId")
-        abs_id = abs_elem.get(f"{{http://schemas.openxmlformats.org/wordprocessingml/2006/main}}val") if abs_elem is not None else None
+            nid_node = _first(_XP_NUMID, num)
+            nid = nid_node.get(_ATTR_VAL) if nid_node is not None else None
+        abs_elem = _first(_XP_ABSNUMID, num)
+        abs_id = abs_elem.get(_ATTR_VAL) if abs_elem is not None else None
         if nid and abs_id:
             numid_to_abstract[nid] = abs_id
 
     # parse abstractNum levels
-    for abs_node in root.findall(f".//{W_NS}abstractNum"):
-        abs_id = abs_node.get(f"{{http://schemas.openxmlformats.org/wordprocessingml/2006/main}}abstractNumId")
+    for abs_node in _XP_ABSNUM(root):
+        abs_id = abs_node.get(_ATTR_ABSID)
         if not abs_id:
             # try attribute with different name
             abs_id = abs_node.get("abstractNumId")
         if not abs_id:
             continue
         levels = {}
-        for lvl in abs_node.findall(f"{W_NS}lvl"):
-            ilvl_raw = lvl.get(f"{{http://schemas.openxmlformats.org/wordprocessingml/2006/main}}ilvl")
+        for lvl in _XP_LVL(abs_node):
+            ilvl_raw = lvl.get(_ATTR_ILVL)
             try:
                 ilvl = int(ilvl_raw) if ilvl_raw is not None else 0
             except Exception:
@@ -290,16 +418,16 @@ def _parse_numbering_xml(numbering_xml: str) -> Dict[str, Any]:
             lvlText = None
             numFmt = None
             start = 1
-            lt = lvl.find(f"{W_NS}lvlText")
+            lt = _first(_XP_LVLTEXT, lvl)
             if lt is not None:
-                lvlText = lt.get(f"{{http://schemas.openxmlformats.org/wordprocessingml/2006/main}}val") or lt.get("val")
-            nf = lvl.find(f"{W_NS}numFmt")
+                lvlText = lt.get(_ATTR_VAL) or lt.get("val")
+            nf = _first(_XP_NUMFMT, lvl)
             if nf is not None:
-                numFmt = nf.get(f"{{http://schemas.openxmlformats.org/wordprocessingml/2006/main}}val") or nf.get("val")
-            st = lvl.find(f"{W_NS}start")
+                numFmt = nf.get(_ATTR_VAL) or nf.get("val")
+            st = _first(_XP_START, lvl)
             if st is not None:
                 try:
-                    start = int(st.get(f"{{http://schemas.openxmlformats.org/wordprocessingml/2006/main}}val") or st.get("val") or "1")
+                    start = int(st.get(_ATTR_VAL) or st.get("val") or "1")
                 except Exception:
                     start = 1
             levels[ilvl] = {"lvlText": lvlText, "numFmt": numFmt, "start": start}
@@ -307,19 +435,23 @@ def _parse_numbering_xml(numbering_xml: str) -> Dict[str, Any]:
 
     return {"numid_to_abstract": numid_to_abstract, "abstract_levels": abstract_levels}
 
-def _compute_number_label_for_para(numid_to_abstract: Dict[str,str], abstract_levels: Dict[str, Dict[int, Dict[str,Any]]], numId: str, ilvl: int, counters_by_num: DefaultDict[str, List[int]]) -> str:
+_ZERO_COUNTERS = array.array("i", [0]) * MAX_NUMBERING_LEVELS
+LVL_TEXT_REF_RE = re.compile(r"%(\d+)")
+
+@lru_cache(maxsize=None)
+def _lvl_text_parts(tpl: str) -> Tuple[Tuple[str, ...], Tuple[int, ...]]:
+    """Split a lvlText template like "%1.%2)" once into literals and 0-based level refs."""
+    parts = LVL_TEXT_REF_RE.split(tpl)
+    return tuple(parts[0::2]), tuple(int(x) - 1 for x in parts[1::2])
+
+def _compute_number_label_for_para(numid_to_abstract: Dict[str,str], abstract_levels: Dict[str, Dict[int, Dict[str,Any]]], numId: str, ilvl: int, counters_by_num: DefaultDict[str, "array.array"]) -> str:
     """
     Update counters_by_num[numId] per ilvl and return label string.
     """
-    # ensure counters list long enough
     arr = counters_by_num[numId]
-    if len(arr) < MAX_NUMBERING_LEVELS:
-        # extend
-        arr.extend([0] * (MAX_NUMBERING_LEVELS - len(arr)))
     # increment this level, reset deeper
     arr[ilvl] += 1
-    for k in range(ilvl+1, MAX_NUMBERING_LEVELS):
-        arr[k] = 0
+    arr[ilvl+1:] = _ZERO_COUNTERS[ilvl+1:]
     # determine template
     abstract = numid_to_abstract.get(numId)
     tpl = None
@@ -330,18 +462,13 @@ def _compute_number_label_for_para(numid_to_abstract: Dict[str,str], abstract_le
             tpl = lvl_info.get("lvlText")
     # If template exists, replace %1, %2 etc.
     if tpl:
-        def repl(m):
-            idx = int(m.group(1)) - 1
-            val = arr[idx] if 0 <= idx < len(arr) else 0
-            return str(val)
-        label = re.sub(r"%(\d+)", repl, tpl)
+        lits, refs = _lvl_text_parts(tpl)
+        out = [lits[0]]
+        for idx, lit in zip(refs, lits[1:]):
+            out.append(str(arr[idx]) if 0 <= idx < MAX_NUMBERING_LEVELS else "0")
+            out.append(lit)
         # make sure label ends with space
-        label = label.strip()
-        if not label.endswith((".", ":", "-", "—")):
-            label = label + " "
-        else:
-            label = label + " "
-        return label
+        return "".join(out).strip() + " "
     # fallback: join levels up to ilvl with '.'
     parts = [str(arr[k]) for k in range(0, ilvl+1) if arr[k] > 0]
     if not parts:
@@ -354,14 +481,13 @@ def extract_docx_lines(path: str) -> List[Dict[str, Union[str, bool]]]:
     Return a list of dicts: {"text": ..., "highlight": True|False}
     Reconstructs numbering labels from numbering.xml when present.
     """
-    _lazy_imports()
     if not os.path.exists(path):
         raise FileNotFoundError(path)
     # Read document.xml
     with zipfile.ZipFile(path) as zf:
         if 'word/document.xml' not in zf.namelist():
             raise RuntimeError("Invalid docx: missing word/document.xml")
-        doc_xml = zf.read('word/document.xml').decode('utf-8')
+        doc_xml = zf.read('word/document.xml')
         numbering_xml = None
         if 'word/numbering.xml' in zf.namelist():
             numbering_xml = zf.read('word/numbering.xml').decode('utf-8')
@@ -376,42 +502,27 @@ def extract_docx_lines(path: str) -> List[Dict[str, Union[str, bool]]]:
         except Exception:
             numid_to_abstract = {}
             abstract_levels = {}
-    # Build paragraph XML list
-    root = ET.fromstring(doc_xml)
-    # Find all w:p elements in order
-    paras = root.findall(f".//{W_NS}p")
     out: List[Dict[str, Union[str, bool]]] = []
     # counters per numId to compute numbering sequences
-    counters_by_num: DefaultDict[str, List[int]] = collections.defaultdict(lambda: [0]*MAX_NUMBERING_LEVELS)
-
-    for p in paras:
-        # Gather all text nodes inside <w:p>
-        texts = []
-        for t in p.findall(f".//{W_NS}t"):
-            if t.text:
-                texts.append(t.text)
+    counters_by_num: DefaultDict[str, "array.array"] = collections.defaultdict(_ZERO_COUNTERS.__copy__)
+
+    for p in _iter_paragraphs(doc_xml):
+        texts = [t.text for t in p.iter(_TAG_T) if t.text]
         para_text = "".join(texts).replace("\r", " ").strip()
-        # detect highlight (shading) inside runs in this paragraph
-        highlight = False
-        # If any w:shd with w:fill attribute is present in this <w:p>, flag highlight
-        if re.search(r'<w:shd[^>]*w:fill="[^"]+"', ET.tostring(p, encoding='unicode'), flags=re.IGNORECASE):
-            # ensure fill isn't empty
-            if re.search(r'<w:shd[^>]*w:fill="([^"]+)"', ET.tostring(p, encoding='unicode'), flags=re.IGNORECASE):
-                highlight = True
-        # detect numbering (w:numPr)
-        numPr = p.find(f"{W_NS}pPr/{W_NS}numPr")
+        # detect numbering (w:numPr); only the paragraph's own pPr counts, so this stays a direct-child lookup
+        numPr = _first(_XP_NUMPR, p)
         label_prefix = ""
         if numPr is not None:
             # find numId and ilvl
-            numIdElem = numPr.find(f"{W_NS}numId")
-            ilvlElem = numPr.find(f"{W_NS}ilvl")
+            numIdElem = _first(_XP_NUMID, numPr)
+            ilvlElem = _first(_XP_ILVL, numPr)
             numId = None
             ilvl = 0
             if numIdElem is not None:
-                numId = numIdElem.get(f"{{http://schemas.openxmlformats.org/wordprocessingml/2006/main}}val") or numIdElem.get("val") or numIdElem.text
+                numId = numIdElem.get(_ATTR_VAL) or numIdElem.get("val") or numIdElem.text
             if ilvlElem is not None:
                 try:
-                    ilvl = int(ilvlElem.get(f"{{http://schemas.openxmlformats.org/wordprocessingml/2006/main}}val") or ilvlElem.get("val") or ilvlElem.text or "0")
+                    ilvl = int(ilvlElem.get(_ATTR_VAL) or ilvlElem.get("val") or ilvlElem.text or "0")
                 except Exception:
                     ilvl = 0
             if numId:
@@ -421,7 +532,9 @@ def extract_docx_lines(path: str) -> List[Dict[str, Union[str, bool]]]:
                     label_prefix = ""
         # If paragraph text empty but numbering label present, still keep label
         final_text = (label_prefix + para_text).strip()
-        out.append({"text": final_text, "highlight": bool(highlight)})
+        # highlight stays off, as before: the original w:shd regex ran over ET.tostring output, where the
+        # prefix is "ns0:", so it never matched; turning detection on changes cast/dialogue segmentation
+        out.append({"text": final_text, "highlight": False})
     # If python-docx (Document) exists, we may prefer its paragraph order/text for robustness:
     # But keep numbering computed above because python-docx does not expose it normally.
     # For now we return out as computed.
@@ -435,33 +548,27 @@ def _ocr_image_to_text(img) -> str:
     res = reader.readtext(img, detail=1, paragraph=False)
     if not res:
         return ""
-    items = []
+    import numpy as np
+    ys_mid: List[float] = []
+    xs_left: List[float] = []
+    texts: List[str] = []
     for bbox, text, conf in res:
         if not text:
             continue
         ys = [pt[1] for pt in bbox]
         xs = [pt[0] for pt in bbox]
-        y = sum(ys) / len(ys)
-        x = min(xs)
-        items.append((y, x, text))
-    items.sort(key=lambda t: (round(t[0] / 8), t[1]))
-    lines = []
-    cur_bucket = None
-    buf = []
-    for y, x, text in items:
-        b = int(round(y / 8))
-        if cur_bucket is None:
-            cur_bucket = b
-            buf = [text]
-        elif b == cur_bucket:
-            buf.append(text)
-        else:
-            lines.append(" ".join(buf))
-            cur_bucket = b
-            buf = [text]
-    if buf:
-        lines.append(" ".join(buf))
-    return "\n".join(lines)
+        ys_mid.append(sum(ys) / len(ys))
+        xs_left.append(min(xs))
+        texts.append(text)
+    if not texts:
+        return ""
+    # 8px row buckets (np.round rounds half to even, like round()); stable lexsort by (bucket, x)
+    buckets = np.round(np.asarray(ys_mid, dtype=np.float64) / 8).astype(np.int64)
+    order = np.lexsort((np.asarray(xs_left, dtype=np.float64), buckets))
+    cuts = (np.flatnonzero(np.diff(buckets[order])) + 1).tolist()
+    words = [texts[i] for i in order.tolist()]
+    bounds = [0] + cuts + [len(words)]
+    return "\n".join(" ".join(words[lo:hi]) for lo, hi in zip(bounds, bounds[1:]))
 
 def extract_pdf_pages(path: str) -> List[str]:
     _lazy_imports()
@@ -473,6 +580,9 @@ def extract_pdf_pages(path: str) -> List[str]:
                 return pages
         except Exception:
             pass
+        # No text layer from PyMuPDF: likely a scan, so warm up OCR while the other extractors are tried
+        if Image:
+            _start_easyocr_preload()
     if _pdfplumber:
         try:
             pages = []
@@ -500,7 +610,6 @@ def extract_pdf_pages(path: str) -> List[str]:
                 return pages
         except Exception:
             pass
-    _lazy_imports()
     if not _fitz or not Image:
         raise RuntimeError(
             "Text extraction failed and OCR fallback unavailable. Install PyMuPDF + Pillow + easyocr."
@@ -521,15 +630,12 @@ def extract_pdf_pages(path: str) -> List[str]:
 # helpers (header/footer cleaning, columns)
 # -------------------------
 def _detect_repeated_lines_across_pages(pages: List[str], min_pages_ratio: float = 0.4) -> List[str]:
-    normalized_lines_per_page = []
-    for p in pages:
-        lines = [normalize_text(l) for l in p.splitlines() if normalize_text(l)]
-        normalized_lines_per_page.append(set(lines))
-    freq = collections.Counter()
-    for s in normalized_lines_per_page:
-        for line in s:
-            if len(line) < 120:
-                freq[line] += 1
+    # per-page dedup (a line counts once per page); long lines are never header/footer candidates
+    normalized_lines_per_page = [
+        {n for n in map(normalize_text, p.splitlines()) if n and len(n) < 120}
+        for p in pages
+    ]
+    freq = collections.Counter(chain.from_iterable(normalized_lines_per_page))
     threshold = max(1, int(len(pages) * min_pages_ratio))
     repeated = [line for line, cnt in freq.items() if cnt >= threshold]
     filtered = [l for l in repeated if not FOOTER_HEADER_CLEAN_RE.match(l)]
@@ -539,6 +645,21 @@ def _clean_headers_footers_from_pages(pages: List[str], verbose_logs: Optional[L
     repeated = _detect_repeated_lines_across_pages(pages)
     if verbose_logs is not None:
         verbose_logs.append(f"Detected {len(repeated)} repeated header/footer candidates")
+    # A line is dropped when it equals a repeated line or one is the other plus " ...".
+    # Both prefix cases become set lookups on space-delimited prefixes.
+    repeated_set = frozenset(repeated)
+    repeated_heads = frozenset(r[:k] for r in repeated for k, ch in enumerate(r) if ch == " ")
+
+    def is_repeated(n: str) -> bool:
+        if n in repeated_set or n in repeated_heads:
+            return True
+        k = n.find(" ")
+        while k != -1:
+            if n[:k] in repeated_set:
+                return True
+            k = n.find(" ", k + 1)
+        return False
+
     cleaned_pages = []
     for p in pages:
         lines = p.splitlines()
@@ -547,7 +668,7 @@ def _clean_headers_footers_from_pages(pages: List[str], verbose_logs: Optional[L
             n = normalize_text(ln)
             if not n:
                 continue
-            if any(n == r or n.startswith(r + " ") or r.startswith(n + " ") for r in repeated):
+            if is_repeated(n):
                 continue
             if PAGE_NUM_RE.match(n):
                 continue
@@ -560,8 +681,8 @@ def _column_choose_most_likely_column(line: str) -> str:
         parts = [p.strip() for p in line.split('\t') if p.strip()]
         if parts:
             return parts[-1]
-    if re.search(r'\s{3,}', line):
-        parts = [p.strip() for p in re.split(r'\s{3,}', line) if p.strip()]
+    if COLUMN_GAP_RE.search(line):
+        parts = [p.strip() for p in COLUMN_GAP_RE.split(line) if p.strip()]
         if parts:
             return parts[-1]
     if '|' in line:
@@ -574,6 +695,10 @@ def _column_choose_most_likely_column(line: str) -> str:
 # segmentation helpers (identical logic retained, highlight-aware)
 # -------------------------
 def _strip_timecode_prefix(text: str) -> str:
+    # a timecode prefix starts with "(" or a digit; skip the regex for everything else
+    c = text[:1]
+    if c != "(" and not c.isdigit():
+        return text
     return TIME_PREFIX_RE.sub("", text, count=1)
 
 def _split_sentences(text: str) -> List[str]:
@@ -588,9 +713,12 @@ def _is_probable_cue(line: str) -> bool:
     s = (line or "").strip()
     if not s:
         return False
-    if re.match(r'^[A-ZА-ЯЁ][a-zа-яё]+(?:\s+[A-ZА-ЯЁ][a-zа-яё]+)?\:??$', s):
+    # Every cue form below has at most 4 words: reject prose lines before running any pattern
+    if len(s.split(None, 4)) > 4:
+        return False
+    if TITLE_CUE_RE.match(s):
         return True
-    if re.search(r'[a-zа-яё]', s) and s.upper() != s:
+    if not LOWER_LETTERS.isdisjoint(s) and s.upper() != s:
         if s.endswith(":") and len(s.split()) <= 3:
             return True
         return False
@@ -605,7 +733,7 @@ def _is_probable_cue(line: str) -> bool:
         return False
     if words and words[0] in {"С", "И", "А", "НА", "В", "ВО", "О", "ОТ", "ДО"}:
         return False
-    if not re.search(r'[A-ZА-ЯЁ]', s):
+    if UPPER_LETTERS.isdisjoint(s):
         return False
     return True
 
@@ -613,24 +741,13 @@ def _ends_open(prev_text: str) -> bool:
     if not prev_text:
         return True
     st = prev_text.rstrip()
-    if not st:
-        return True
-    if re.search(r'[\.!\?…:]$', st):
-        return False
-    if DASH_END_RE.search(st):
-        return True
-    if re.search(r'[,;]\s*$', st):
-        return True
-    return True
+    # only closing punctuation ends a block; a trailing dash, comma or anything else leaves it open
+    return not st or st[-1] not in CLOSING_PUNCT
 
 def _is_parenthetical(text: str) -> bool:
     t = (text or "").strip()
     return t.startswith("(") and len(t) > 1
 
-def _is_short_parenthetical(text: str) -> bool:
-    t = (text or "").strip()
-    return _is_parenthetical(t) and len(t) <= 60
-
 def _merge_action_blocks(blocks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     if not blocks:
         return blocks
@@ -651,13 +768,12 @@ def _merge_action_blocks(blocks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         cond = (
             _ends_open(prev)
             or _is_parenthetical(curr)
-            or _is_short_parenthetical(curr)
             or (curr and (curr[0].islower() or COMMON_LOWER_START.match(curr)))
             or UPPER_COMMA_CONT_RE.match(curr)
         )
         if cond:
-            if DASH_END_RE.search(prev.rstrip()):
-                prev = re.sub(DASH_END_RE, "", prev).rstrip()
+            if prev.rstrip().endswith(DASH_ENDINGS):
+                prev = DASH_END_RE.sub("", prev).rstrip()
                 buf["text"] = prev
             buf["text"] = (buf["text"].rstrip() + " " + curr.lstrip()).strip()
         else:
@@ -667,19 +783,23 @@ def _merge_action_blocks(blocks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         merged.append(buf)
     for m in merged:
         if m["type"] == "action":
-            m["text"] = re.sub(r"\s{2,}", " ", m["text"]).strip()
-            if m["text"].endswith('-') and not re.search(r'\w-\Z', m["text"]):
+            m["text"] = MULTI_WS_RE.sub(" ", m["text"]).strip()
+            if m["text"].endswith('-') and not WORD_DASH_END_RE.search(m["text"]):
                 m["text"] = m["text"][:-1].rstrip()
     return merged
 
 def _is_slug(line: str) -> Optional[dict]:
     txt = line.strip()
-    if not txt:
+    if not txt or txt[0] not in _SLUG_FIRST_CHARS:
+        return None
+    # Without a leading number/suffix/note the line must open with the IE token itself:
+    # check that cheap anchored prefix before the full SLUG_RE
+    if txt[0] not in _SLUG_NUMBER_CHARS and not IE_LINE_RE.match(txt):
         return None
     m = SLUG_RE.match(txt)
     if m:
         gd = m.groupdict()
-        if not gd.get("num") and not re.match(rf"^{IE_TOK}\b", txt, re.IGNORECASE):
+        if not gd.get("num") and not IE_LINE_RE.match(txt):
             return None
         rest = gd.get("rest") or ""
         if rest and COMMON_LOWER_START.match(rest.strip()):
@@ -693,11 +813,11 @@ def _is_slug(line: str) -> Optional[dict]:
             timecode = (rm.group("timecode") or "")
         if not (loc or tod or shoot_day or timecode):
             rest_up = (rest or "").upper()
-            if rest_up and re.search(r'\b(INT|ИНТ|EXT|ЭКСТ|NAT|НАТ|ДЕНЬ|НОЧЬ|УТРО|ВЕЧЕР)\b', rest_up):
+            if rest_up and SLUG_REST_KEYWORD_RE.search(rest_up):
                 loc = rest.strip()
         if not loc and not tod and not shoot_day and not timecode:
             return None
-        ie = re.sub(r"\s*/\s*", "/", (gd.get("ie") or "").upper()).rstrip(".")
+        ie = SLASH_WS_RE.sub("/", (gd.get("ie") or "").upper()).rstrip(".")
         return {
             "raw": txt,
             "number": gd.get("num") or "",
@@ -709,8 +829,9 @@ def _is_slug(line: str) -> Optional[dict]:
             "timecode": timecode,
             "removed": bool(gd.get("removed"))
         }
-    if re.match(rf"^\s*{IE_TOK}\b", txt, re.IGNORECASE):
-        rest = re.sub(rf"^\s*{IE_TOK}\b\.?\s*", "", txt, flags=re.IGNORECASE).strip()
+    ie_m = IE_LINE_RE.match(txt)
+    if ie_m:
+        rest = IE_STRIP_RE.sub("", txt, count=1).strip()
         rm = REST_TIME_RE.match(rest)
         loc = tod = shoot_day = timecode = ""
         if rm:
@@ -722,8 +843,7 @@ def _is_slug(line: str) -> Optional[dict]:
             if rest and not COMMON_LOWER_START.match(rest):
                 loc = rest
         if loc or tod or shoot_day or timecode:
-            ie = re.match(rf"^\s*{IE_TOK}\b", txt, re.IGNORECASE).group(0).upper()
-            ie = re.sub(r"\s*/\s*", "/", ie).rstrip(".")
+            ie = SLASH_WS_RE.sub("/", ie_m.group(0).upper()).rstrip(".")
             return {
                 "raw": txt,
                 "number": "",
@@ -738,27 +858,13 @@ def _is_slug(line: str) -> Optional[dict]:
     return None
 
 def _try_join_slug_wrapped(lines: List[Union[str, Dict[str,Any]]], i: int) -> Optional[Tuple[str, int]]:
-    def get_text(idx):
-        ln = lines[idx]
-        if isinstance(ln, dict):
-            return ln.get("text","")
-        return ln
-    head = get_text(i).rstrip()
-    if SLUG_HEAD_RE.match(head):
-        for extra in range(1, 4):
-            if i + extra < len(lines):
-                cand = head
-                for k in range(1, extra + 1):
-                    cand = (cand + " " + get_text(i + k).lstrip()).strip()
-                if _is_slug(cand):
-                    return cand, extra
-    for extra in range(1, 4):
-        if i + extra < len(lines):
-            cand = get_text(i).rstrip()
-            for k in range(1, extra + 1):
-                cand = (cand + " " + get_text(i + k).lstrip()).strip()
-            if _is_slug(cand):
-                return cand, extra
+    # Texts of the line and up to 3 following ones are read once; each candidate extends the previous one
+    texts = [ln.get("text","") if isinstance(ln, dict) else ln for ln in lines[i:i + 4]]
+    cand = texts[0].rstrip()
+    for extra in range(1, len(texts)):
+        cand = (cand + " " + texts[extra].lstrip()).strip()
+        if _is_slug(cand):
+            return cand, extra
     return None
 
 def _finalize_scene(scene: Dict[str, Any], verbose_logs: Optional[List[str]] = None) -> Dict[str, Any]:
@@ -802,12 +908,6 @@ def segment_lines_to_scenes(lines: List[Union[str, Dict[str,Any]]], skip_removed
     """
     logs: List[str] = [] if verbose else None
 
-    def get_text(idx):
-        ln = lines[idx]
-        if isinstance(ln, dict):
-            return normalize_text(ln.get("text",""))
-        return normalize_text(ln or "")
-
     def get_highlight(idx):
         ln = lines[idx]
         if isinstance(ln, dict):
@@ -840,6 +940,7 @@ def segment_lines_to_scenes(lines: List[Union[str, Dict[str,Any]]], skip_removed
             collapsed.append(ln)
             prev_blank = False
     norm = collapsed
+    texts: List[str] = [ln["text"] if isinstance(ln, dict) else ln for ln in norm]
 
     scenes: List[Dict[str, Any]] = []
     cur: Optional[Dict[str, Any]] = None
@@ -858,8 +959,7 @@ def segment_lines_to_scenes(lines: List[Union[str, Dict[str,Any]]], skip_removed
     i = 0
     n = len(norm)
     while i < n:
-        ln = norm[i]
-        line = ln["text"] if isinstance(ln, dict) else ln
+        line = texts[i]
         if not line:
             close_dialogue()
             i += 1
@@ -868,7 +968,7 @@ def segment_lines_to_scenes(lines: List[Union[str, Dict[str,Any]]], skip_removed
         # Try slug on current raw (numbering prefix preserved if present)
         slug = _is_slug(line)
         if not slug:
-            joined = _try_join_slug_wrapped(norm, i)
+            joined = _try_join_slug_wrapped(texts, i)
             if joined:
                 jline, extra = joined
                 slug = _is_slug(jline)
@@ -902,7 +1002,7 @@ def segment_lines_to_scenes(lines: List[Union[str, Dict[str,Any]]], skip_removed
             continue
 
         if cur is None:
-            if re.match(rf"^\s*{IE_TOK}\b", line, re.IGNORECASE):
+            if IE_LINE_RE.match(line):
                 fake_slug = _is_slug(line) or {"raw": line, "number": "", "number_suffix": "", "ie": line.split()[0].upper(), "location": "", "time_of_day": "", "shoot_day": "", "timecode": "", "removed": False}
                 cur = {
                     "heading": fake_slug["raw"],
@@ -926,13 +1026,13 @@ def segment_lines_to_scenes(lines: List[Union[str, Dict[str,Any]]], skip_removed
         # Vertical cast block detection ignoring highlighted lines as candidates
         j = i
         names_block = []
-        while j < n and ( (norm[j]["text"] if isinstance(norm[j], dict) else norm[j]).strip() ) and len(names_block) < MAX_VERTICAL_CAST_LINES:
-            candidate = norm[j]["text"] if isinstance(norm[j], dict) else norm[j]
+        while j < n and texts[j].strip() and len(names_block) < MAX_VERTICAL_CAST_LINES:
+            candidate = texts[j]
             candidate_highlight = get_highlight(j)
             if candidate_highlight:
                 break
-            if (re.match(r'^[A-ZА-ЯЁ][A-ZА-ЯЁ\-\s\.]+$', candidate) and not re.search(r'[0-9;:!?]', candidate)) \
-               or (len(candidate.split()) <= 3 and not re.search(r'[0-9;:!?\.]', candidate) and candidate.istitle()):
+            if (VERTICAL_NAME_RE.match(candidate) and not VERTICAL_REJECT_RE.search(candidate)) \
+               or (len(candidate.split()) <= 3 and not VERTICAL_TITLE_REJECT_RE.search(candidate) and candidate.istitle()):
                 if len(candidate) <= MAX_LINE_LEN_FOR_NAME:
                     names_block.append(candidate)
                     j += 1
@@ -957,7 +1057,7 @@ def segment_lines_to_scenes(lines: List[Union[str, Dict[str,Any]]], skip_removed
             continue
 
         # legacy uppercase cast line (skip if highlighted)
-        if not highlight_here and re.search(r'[A-ZА-ЯЁ].*,.*[A-ZА-ЯЁ]', line) and line.strip().upper() == line.strip():
+        if not highlight_here and UPPER_LIST_RE.search(line) and line.strip().upper() == line.strip():
             close_dialogue()
             parts = [p.strip() for p in line.split(",") if p.strip()]
             if sum(1 for p in parts if looks_like_name(p)) >= 1:
@@ -977,7 +1077,7 @@ def segment_lines_to_scenes(lines: List[Union[str, Dict[str,Any]]], skip_removed
             continue
 
         # inline "Name + rest"
-        m_name_rest = re.match(r'^([A-ZА-ЯЁ][a-zа-яё\-]+(?:\s+[A-ZА-ЯЁ][a-zа-яё\-]+)?)\s+(.+)$', line)
+        m_name_rest = NAME_REST_RE.match(line)
         if m_name_rest:
             maybe_name, rest = m_name_rest.group(1), m_name_rest.group(2)
             if looks_like_name(maybe_name):
@@ -1014,7 +1114,7 @@ def segment_lines_to_scenes(lines: List[Union[str, Dict[str,Any]]], skip_removed
             internal_lines = [ln for ln in combined.splitlines() if ln.strip()]
             split_found = False
             for idx, candidate in enumerate(internal_lines):
-                if re.match(rf"^\s*{IE_TOK}\b", candidate, re.IGNORECASE) and idx > 2:
+                if IE_LINE_RE.match(candidate) and idx > 2:
                     cut_text = "\n".join(internal_lines[:idx])
                     rest_text = "\n".join(internal_lines[idx:])
                     cur["blocks"] = [{"type":"action","text":cut_text,"line_no":cur["blocks"][0].get("line_no") if cur["blocks"] else None}]
@@ -1049,9 +1149,8 @@ def segment_lines_to_scenes(lines: List[Union[str, Dict[str,Any]]], skip_removed
         if verbose:
             logs.append("No scenes detected by primary pass — applying fallback split by IE tokens.")
         cur = None
-        for idx, ln in enumerate(norm):
-            line = ln["text"] if isinstance(ln, dict) else ln
-            if re.search(rf"\b{IE_TOK}\b", line, re.IGNORECASE):
+        for idx, line in enumerate(texts):
+            if IE_ANYWHERE_RE.search(line):
                 if cur:
                     _finalize_scene(cur, logs)
                     scenes.append(cur)